@@ -2,9 +2,26 @@
 # ep_1setup.py by Vaclav Hasik
 
 from sys import platform
+from platform import system
 import os
 import timeit
+import itertools
+import random
+import json
+import csv
+import multiprocessing
+import hashlib
+import pickle
+import numpy as np
+import eppy
 from eppy.modeleditor import IDF
+from eppy.idfreader import iddversiontuple
+from eppy.EPlusInterfaceFunctions.parse_idd import extractidddata
+
+# Compiled templates held by each generate_parallel() worker process
+WORKER = {}
+# Summary tables read by ep_3results, the only reports requested in the minimal output mode
+MINIMAL_REPORTS = ['AnnualBuildingUtilityPerformanceSummary', 'EnvelopeSummary']
 
 
 '''
@@ -22,19 +39,10 @@ def main():
     start = timeit.default_timer()
 
     # Check for operating system and setup appropriate energyplus path
-    if platform == "linux" or platform == "linux2":
-        print('Linux operating system identified... sorry, it is not supported.')
-    elif platform == "darwin":
-        print('Mac operating system identified.\nIDD path setup completed.\n')
-        ep_path = '/Applications/EnergyPlus-8-8-0/energyplus'
-        idd_path = '/Applications/EnergyPlus-8-8-0/Energy+.idd'
-    elif platform == "win32":
-        print('Windows operating system identified.\nIDD path setup completed.\n')
-        ep_path = 'C:/EnergyPlusV8-8-0/energyplus.exe'
-        idd_path = 'C:/EnergyPlusV8-8-0/Energy+.idd'
+    ep_path, idd_path = energyplus_paths()
 
-    # Setup idd file
-    IDF.setiddname(idd_path)
+    # Setup idd file from the pre-parsed cache
+    setup_idd(idd_path)
 
     # Check for idf files
     # Define template file path
@@ -47,46 +55,59 @@ def main():
     idf_count = len(idf_files)
     print('There are {} idf files in the "{}" directory.'.format(idf_count, idf_path))
 
-    # Load individual template files
-    idf_data = IDF('{}/{}.idf'.format(idf_path, 'skp_data'))  # Simulation setup
-    idf_skp01 = IDF('{}/{}.idf'.format(idf_path, 'skp_01'))  # Geometry, glazing
-    idf_skp05 = IDF('{}/{}.idf'.format(idf_path, 'skp_05'))  # Glazing
-    idf_skp09 = IDF('{}/{}.idf'.format(idf_path, 'skp_09'))  # Geometry, glazing
-    idf_skp13 = IDF('{}/{}.idf'.format(idf_path, 'skp_13'))  # Glazing
-
-    save_path = './Models/ss1_idfs'
-    idf_count = 16
-
-    geometries = [idf_skp01, idf_skp09]
-    glazings = [idf_skp01, idf_skp05, idf_skp09, idf_skp13]
-    walls = ['Wall A', 'Wall B']
-    windows = ['Window A', 'Window B']
-    name_nos = ["%.2d" % i for i in range(idf_count)]
-
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp01, 'Wall A', 'Window A', 'ss1_01')
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp01, 'Wall B', 'Window A', 'ss1_02')
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp01, 'Wall A', 'Window B', 'ss1_03')
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp01, 'Wall B', 'Window B', 'ss1_04')
-
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp05, 'Wall A', 'Window A', 'ss1_05')
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp05, 'Wall B', 'Window A', 'ss1_06')
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp05, 'Wall A', 'Window B', 'ss1_07')
-    generate_idf(save_path, idf_data, idf_skp01, idf_skp05, 'Wall B', 'Window B', 'ss1_08')
-
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp09, 'Wall A', 'Window A', 'ss1_09')
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp09, 'Wall B', 'Window A', 'ss1_10')
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp09, 'Wall A', 'Window B', 'ss1_11')
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp09, 'Wall B', 'Window B', 'ss1_12')
-
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp13, 'Wall A', 'Window A', 'ss1_13')
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp13, 'Wall B', 'Window A', 'ss1_14')
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp13, 'Wall A', 'Window B', 'ss1_15')
-    generate_idf3(save_path, idf_data, idf_skp09, idf_skp13, 'Wall B', 'Window B', 'ss1_16')
-
-    idf_list = []
-    for design in range(1, idf_count + 1):
-        idf_file = modify_idf(design, idf_count, save_path)
-        idf_list.append(idf_file)
+    # Load the design space spec and expand it into a list of variants
+    design_space, variants = load_study('./Models/design_space.json')
+    idf_count = len(variants)
+
+    save_path = './Models/{}_idfs'.format(design_space['group'])
+    os.makedirs(save_path, exist_ok=True)
+    save_variant_table(variants, '{}/{}_variants.csv'.format(save_path, design_space['group']))
+
+    # Only rebuild the variants whose templates or factor levels changed since the last run
+    manifest_file = '{}/{}_manifest.json'.format(save_path, design_space['group'])
+    manifest = load_manifest(manifest_file)
+    template_hashes = hash_templates(idf_path, variants)
+    stale = stale_variants(variants, manifest, template_hashes, save_path)
+    print('{} of {} variants need to be regenerated.'.format(len(stale), idf_count))
+
+    # Bills of quantities are kept per variant as well, rebuild them with the variants
+    quantities_file = '{}/{}_quantities.csv'.format(save_path, design_space['group'])
+    quantities = load_quantities(quantities_file)
+    stale_names = {v['Name'] for v in stale}
+    rebuild = [v for v in variants if v['Name'] in stale_names or v['Name'] not in quantities]
+
+    # Load only the template files referenced by the stale variants
+    templates = load_templates(idf_path, rebuild) if rebuild else {}
+
+    # Generate the variants, every edit is applied before the single write to disk
+    emitter = 'text'    # Options: text (serialize shared blocks once and splice), eppy (copyidfobject per variant)
+    processes = os.cpu_count()  # Worker processes for the text emitter, 1 generates serially
+    if not stale:
+        pass
+    elif emitter == 'text' and processes > 1:
+        generate_parallel(stale, templates, save_path, processes, designs=idf_count)
+    elif emitter == 'text':
+        for variant, idf_text in iter_variants(stale, templates, designs=idf_count):
+            write_idf(save_path, idf_text, variant['Name'])
+    else:
+        generators = {'generate_idf': generate_idf, 'generate_idf3': generate_idf3}
+        for variant in stale:
+            generate = generators[variant['Generator']]
+            generate(save_path, templates['skp_data'], templates[variant['Geometry']],
+                     templates[variant['Glazing']], variant['Wall'], variant['Window'], variant['Name'],
+                     floor_type=variant['Floor'], ceiling_type=variant['Ceiling'],
+                     roof_type=variant['Roof'], building_name=building_name(variant, idf_count),
+                     north_axis=variant['North_Axis'], outputs=variant['Outputs'])
+
+    # Construction areas from the surface vertices, so materials can be screened without a simulation
+    quantities = update_quantities(quantities, variants, rebuild, templates, idf_count)
+    save_quantities(quantities_file, quantities)
+    print('Bill of quantities exported to "{}".'.format(quantities_file))
+
+    # Record the inputs and output of every variant for the next run
+    manifest = update_manifest(manifest, variants, template_hashes, save_path)
+    save_manifest(manifest_file, manifest)
+    idf_list = ['{}/{}.idf'.format(save_path, variant['Name']) for variant in variants]
 
     print(idf_list)
 
@@ -107,7 +128,9 @@ FUNCTIONS
 '''
 
 
-def generate_idf(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type, window_type, save_as):
+def generate_idf(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type, window_type, save_as,
+                 floor_type='Slab A', ceiling_type='Slab A', roof_type='Roof A', building_name=None, north_axis=0,
+                 outputs='full'):
     # Definitions
     mater = 'Material'
     glazi = 'WindowMaterial:SimpleGlazingSystem'
@@ -245,10 +268,6 @@ def generate_idf(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type,
     new_subsurface = idf2.idfobjects[fenes.upper()]
 
     # Change the construction of each surface and glazing
-    floor_type = 'Slab A'
-    ceiling_type = 'Slab A'
-    roof_type = 'Roof A'
-
     for surface in new_surface:
         if surface['Surface_Type'] == 'Floor':
             surface.Construction_Name = floor_type
@@ -263,6 +282,14 @@ def generate_idf(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type,
         if subsurface['Surface_Type'] == 'Window':
             subsurface.Construction_Name = window_type
 
+    # Building name and orientation
+    building = idf2.idfobjects['BUILDING'][0]
+    if building_name is not None:
+        building.Name = building_name
+    building.North_Axis = north_axis
+    if outputs == 'minimal':
+        minimal_outputs(idf2)
+
     # Save to the disk and return to main
     idf2.saveas('{}/{}.idf'.format(save_path, save_as))
     idf_file = '{}/{}.idf'.format(save_path, save_as)
@@ -270,7 +297,9 @@ def generate_idf(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type,
     return idf_file
 
 
-def generate_idf3(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type, window_type, save_as):
+def generate_idf3(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type, window_type, save_as,
+                  floor_type='Slab A', ceiling_type='Slab A', roof_type='Roof A', building_name=None, north_axis=0,
+                  outputs='full'):
     mater = 'Material'  # All
     glazi = 'WindowMaterial:SimpleGlazingSystem'  # All
     const = 'Construction'  # All
@@ -434,10 +463,6 @@ def generate_idf3(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type
     new_subsurface = idf2.idfobjects[fenes.upper()]
 
     # Now I want to change the construction of each surface and glazing.
-    floor_type = 'Slab A'
-    ceiling_type = 'Slab A'
-    roof_type = 'Roof A'
-
     for surface in new_surface:
         if surface['Surface_Type'] == 'Floor':
             surface.Construction_Name = floor_type
@@ -458,6 +483,14 @@ def generate_idf3(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type
         if subsurface['Surface_Type'] == 'Window':
             subsurface.Construction_Name = window_type
 
+    # Building name and orientation
+    building = idf2.idfobjects['BUILDING'][0]
+    if building_name is not None:
+        building.Name = building_name
+    building.North_Axis = north_axis
+    if outputs == 'minimal':
+        minimal_outputs(idf2)
+
     # Save it to the disk.
     idf2.saveas('{}/{}.idf'.format(save_path, save_as))
     idf_file = '{}/{}.idf'.format(save_path, save_as)
@@ -465,26 +498,591 @@ def generate_idf3(save_path, idf_data, idf_surfaces, idf_fenestration, wall_type
     return idf_file
 
 
-def modify_idf(design, designs, idf_path):
-    # Load idf file
-    idf1 = IDF('./Models/ss1_idfs/ss1_{:02d}.idf'.format(design))
+def compile_shared(idf_data, outputs='full'):
+    # Serialize the blocks every variant copies from the data template, once for the whole study
+    single = ['Version', 'SimulationControl', 'RunPeriod', 'Building', 'Timestep', 'SizingPeriod:WeatherFileDays',
+              'RunPeriodControl:DaylightSavingTime', 'Site:GroundTemperature:BuildingSurface', 'GlobalGeometryRules',
+              'HVACTemplate:Thermostat', 'HVACTemplate:System:PackagedVAV']
+    output = ['Output:Surfaces:Drawing', 'OutputControl:Table:Style', 'Output:Table:SummaryReports']
+    every = ['Schedule:Compact', 'ScheduleTypeLimits', 'Schedule:Day:Interval', 'Schedule:Week:Daily',
+             'Schedule:Year', 'Schedule:Constant',
+             'Material', 'WindowMaterial:SimpleGlazingSystem', 'Construction']
+
+    objects = [idf_data.idfobjects[key.upper()][0] for key in single if key != 'Building']
+    if outputs == 'minimal':
+        # Rewrite the output objects on copies, the data template itself stays as it is
+        idf_output = IDF()
+        idf_output.new()
+        for key in output:
+            idf_output.copyidfobject(idf_data.idfobjects[key.upper()][0])
+        minimal_outputs(idf_output)
+        for key in output:
+            objects += list(idf_output.idfobjects[key.upper()])
+    else:
+        objects += [idf_data.idfobjects[key.upper()][0] for key in output]
+    for key in every:
+        objects += list(idf_data.idfobjects[key.upper()])
+    building = idf_data.idfobjects['BUILDING'][0]
+
+    # Zone level objects are taken from the data template by generate_idf and from the geometry by generate_idf3
+    zoning = ['ZoneVentilation:DesignFlowRate', 'ZoneInfiltration:DesignFlowRate', 'ZoneList',
+              'People', 'Lights', 'ElectricEquipment']
+    zones = [idf_data.idfobjects[key.upper()][0] for key in zoning + ['Zone', 'HVACTemplate:Zone:VAV']]
+
+    shared = {'order': {key: i for i, key in enumerate(idf_data.model.dtls)},
+              'objects': [(obj.key.upper(), [repr(obj)]) for obj in objects] +
+                         [(building.key.upper(), template_segments(building, {'Name': 'Building',
+                                                                              'North_Axis': 'North_Axis'}))],
+              'zones': [(obj.key.upper(), [repr(obj)]) for obj in zones],
+              'zoning': zoning}
+
+    return shared
+
+
+def compile_template(shared, idf_surfaces, idf_fenestration, generator):
+    # Combine the shared blocks with one geometry/glazing pair.
+    # Construction names of the surfaces become slots that are filled in for every variant.
+    objects = list(shared['objects'])
+    if generator == 'generate_idf3':
+        zones = [idf_surfaces.idfobjects[key.upper()][0] for key in shared['zoning']]
+        zones += list(idf_surfaces.idfobjects['ZONE']) + list(idf_surfaces.idfobjects['HVACTEMPLATE:ZONE:VAV'])
+        objects += [(obj.key.upper(), [repr(obj)]) for obj in zones]
+    else:
+        objects += shared['zones']
+
+    for surface in idf_surfaces.idfobjects['BUILDINGSURFACE:DETAILED']:
+        slot = surface['Surface_Type'] if surface['Surface_Type'] in ('Floor', 'Ceiling', 'Roof', 'Wall') else None
+        objects.append((surface.key.upper(), template_segments(surface, {'Construction_Name': slot})))
+    for subsurface in idf_fenestration.idfobjects['FENESTRATIONSURFACE:DETAILED']:
+        slot = 'Window' if subsurface['Surface_Type'] == 'Window' else None
+        objects.append((subsurface.key.upper(), template_segments(subsurface, {'Construction_Name': slot})))
+
+    # Keep the same object order as IDF.saveas (IDD order) so both emitters write identical files
+    objects.sort(key=lambda item: shared['order'][item[0]])
+
+    # Merge neighbouring literal text so rendering is a single pass over few segments
+    template = []
+    for key, segments in objects:
+        for segment in segments:
+            if isinstance(segment, str) and template and isinstance(template[-1], str):
+                template[-1] += segment
+            else:
+                template.append(segment)
+
+    return template
+
+
+def minimal_outputs(idf):
+    # Request only the tables ep_3results reads, in the XML file only, and no DXF drawing of the surfaces
+    for drawing in list(idf.idfobjects['OUTPUT:SURFACES:DRAWING']):
+        idf.removeidfobject(drawing)
+    style = idf.idfobjects['OUTPUTCONTROL:TABLE:STYLE'][0]
+    style.Column_Separator = 'XML'
+    reports = idf.idfobjects['OUTPUT:TABLE:SUMMARYREPORTS'][0]
+    reports.obj = reports.obj[:1] + MINIMAL_REPORTS
+
+    return idf
+
+
+def template_segments(obj, slots):
+    # Split the IDF text of an object into literal text and (slot, terminator, comment) fields
+    lines = repr(obj).split('\n')
+    segments = []
+    for field, slot in slots.items():
+        if slot is None:
+            continue
+        # repr() starts with a blank line followed by the object key, so field i is on line i + 1
+        line_no = obj.objls.index(field) + 1
+        line = lines[line_no]
+        value, comment = line.split('!-', 1)
+        terminator = value.rstrip()[-1]
+        lines[line_no] = (slot, terminator, comment)
+
+    text = ''
+    for i, line in enumerate(lines):
+        if isinstance(line, tuple):
+            segments += [text + '\n', line]
+            text = ''
+        else:
+            text += ('\n' if i else '') + line
+    segments.append(text)
+
+    # Drop the newline added in front of the first line
+    if segments[0] == '\n':
+        segments.pop(0)
+    elif isinstance(segments[0], str) and segments[0].startswith('\n\n'):
+        segments[0] = segments[0][1:]
+
+    return segments
+
+
+def render_template(template, values):
+    # Fill the slots with the construction names of one variant, padded the same way eppy does it
+    text = []
+    for segment in template:
+        if isinstance(segment, str):
+            text.append(segment)
+        else:
+            slot, terminator, comment = segment
+            text.append('    {}{}'.format(values[slot], terminator).ljust(26) + '    !-' + comment)
+
+    return ''.join(text)
+
+
+def building_name(variant, designs):
+    return 'Building Design {:02d}/{:02d}'.format(variant['Design'], designs)
+
+
+def variant_values(variant, designs):
+    # Construction assigned to each surface type, building name and orientation of a variant
+    values = {'Floor': variant['Floor'],
+              'Ceiling': variant['Ceiling'],
+              'Roof': variant['Roof'],
+              'Wall': variant['Wall'],
+              'Window': variant['Window'],
+              'Building': building_name(variant, designs),
+              'North_Axis': idf_number(variant['North_Axis'])}
+
+    return values
+
+
+def idf_number(value):
+    # Write whole numbers without decimals, the same way eppy does it
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+
+    return value
+
+
+def compile_variants(variants, templates):
+    # Compile every geometry/glazing pair (and output mode) used by the variants once
+    shared = {}
+    compiled = {}
+    for variant in variants:
+        key = template_key(variant)
+        if variant['Outputs'] not in shared:
+            shared[variant['Outputs']] = compile_shared(templates['skp_data'], variant['Outputs'])
+        if key not in compiled:
+            compiled[key] = compile_template(shared[variant['Outputs']], templates[variant['Geometry']],
+                                             templates[variant['Glazing']], variant['Generator'])
+
+    return compiled
+
+
+def template_key(variant):
+    return variant['Geometry'], variant['Glazing'], variant['Generator'], variant['Outputs']
+
+
+def iter_variants(variants, templates, designs=None):
+    # Lazily yield (variant, idf text) pairs, designs is the size of the whole study used in the building names.
+    # The text can be written with write_idf(), handed to the simulation stage, or read with IDF(StringIO(text)).
+    compiled = compile_variants(variants, templates)
+    if designs is None:
+        designs = len(variants)
+    for variant in variants:
+        yield variant, render_variant(compiled, variant, designs)
+
+
+def render_variant(compiled, variant, designs):
+    # IDF text of one variant from the templates compiled with compile_variants()
+    return render_template(compiled[template_key(variant)], variant_values(variant, designs))
+
 
-    # Setup fields to be changed
-    building = 'Building'
-    building = idf1.idfobjects[building.upper()][0]
+def generate_parallel(variants, templates, save_path, processes=None, designs=None):
+    # Spread the variants over worker processes.
+    # Templates are parsed and compiled once here; workers only receive the compiled text, once each.
+    compiled = compile_variants(variants, templates)
+    if processes is None:
+        processes = os.cpu_count()
+    if designs is None:
+        designs = len(variants)
+    chunksize = max(1, len(variants) // (processes * 4))
+    with multiprocessing.Pool(processes, initializer=init_worker,
+                              initargs=(compiled, save_path, designs)) as pool:
+        # map() keeps the variant order, file names come from the variants themselves
+        idf_list = pool.map(generate_worker, variants, chunksize=chunksize)
 
-    # Set object information
-    building.Name = 'Building Design {:02d}/{:02d}'.format(design, designs)
-    building.North_Axis = '0'
+    return idf_list
 
-    print('IDF file setup for {} completed'.format(building.Name))
 
-    idf_path = './Models/ss1_idfs'
+def init_worker(compiled, save_path, designs):
+    WORKER['compiled'] = compiled
+    WORKER['save_path'] = save_path
+    WORKER['designs'] = designs
 
-    idf1.saveas('{}/ss1_{:02d}.idf'.format(idf_path, design))
-    idf_file = '{}/ss1_{:02d}.idf'.format(idf_path, design)
+
+def generate_worker(variant):
+    idf_text = render_variant(WORKER['compiled'], variant, WORKER['designs'])
+
+    return write_idf(WORKER['save_path'], idf_text, variant['Name'])
+
+
+def write_idf(save_path, idf_text, save_as):
+    # Same header, line endings and encoding as IDF.saveas
+    idf_file = '{}/{}.idf'.format(save_path, save_as)
+    idf_text = '!- {} Line endings \n'.format(system()) + idf_text
+    with open(idf_file, 'wb') as f:
+        f.write(os.linesep.join(idf_text.splitlines()).encode('latin-1'))
 
     return idf_file
 
 
+def load_study(spec_file):
+    # Load the design space spec (a json file if present, otherwise the built-in study)
+    if os.path.isfile(spec_file):
+        design_space = load_design_space(spec_file)
+        print('Design space loaded from "{}".'.format(spec_file))
+    else:
+        design_space = default_design_space()
+        print('Design space file not found, using the default study.')
+
+    variants = expand_design_space(design_space)
+    print('{} design space ({}) expanded into {} variants.'.format(
+        design_space['group'], design_space.get('method', 'full'), len(variants)))
+
+    return design_space, variants
+
+
+def load_templates(idf_path, variants):
+    template_names = sorted({'skp_data'} | {v['Geometry'] for v in variants} | {v['Glazing'] for v in variants})
+    templates = {}
+    for name in template_names:
+        templates[name] = IDF('{}/{}.idf'.format(idf_path, name))
+
+    return templates
+
+
+def polygon_areas(polygons):
+    # Areas of planar 3D polygons given as lists of (x, y, z) vertices.
+    # Polygons are padded to a common vertex count by repeating their last vertex, which adds zero-length edges,
+    # so all of them are handled in one array: area = |sum(v_i x v_i+1)| / 2
+    if not polygons:
+        return np.zeros(0)
+    vertex_count = max(len(polygon) for polygon in polygons)
+    vertices = np.array([polygon + [polygon[-1]] * (vertex_count - len(polygon)) for polygon in polygons], dtype=float)
+    cross = np.cross(vertices, np.roll(vertices, -1, axis=1)).sum(axis=1)
+
+    return 0.5 * np.linalg.norm(cross, axis=1)
+
+
+def surface_vertices(surface):
+    # Vertex coordinates follow the Number_of_Vertices field
+    values = surface.fieldvalues
+    first = surface.fieldnames.index('Number_of_Vertices') + 1
+    count = int(values[first - 1]) if values[first - 1] not in ('', 'autocalculate') else (len(values) - first) // 3
+    coordinates = [float(value) for value in values[first:first + 3 * count]]
+
+    return [coordinates[i:i + 3] for i in range(0, len(coordinates), 3)]
+
+
+def compile_quantities(idf_surfaces, idf_fenestration):
+    # Exterior surfaces of one geometry/glazing pair with their construction slot and area.
+    # Opaque areas are net of the windows and doors placed in them, like EnvelopeSummary/OpaqueExterior.
+    surfaces = [s for s in idf_surfaces.idfobjects['BUILDINGSURFACE:DETAILED']
+                if s['Outside_Boundary_Condition'] == 'Outdoors' or s['Outside_Boundary_Condition'].startswith('Ground')]
+    subsurfaces = [s for s in idf_fenestration.idfobjects['FENESTRATIONSURFACE:DETAILED']
+                   if s['Building_Surface_Name'] in {surface.Name for surface in surfaces}]
+
+    gross = polygon_areas([surface_vertices(s) for s in surfaces])
+    openings = polygon_areas([surface_vertices(s) for s in subsurfaces])
+    openings *= np.array([float(s['Multiplier'] or 1) for s in subsurfaces])
+
+    parents = {surface.Name: i for i, surface in enumerate(surfaces)}
+    net = gross.copy()
+    np.subtract.at(net, [parents[s['Building_Surface_Name']] for s in subsurfaces], openings)
+
+    records = []
+    for surface, area in zip(surfaces, net):
+        slot = surface['Surface_Type'] if surface['Surface_Type'] in ('Floor', 'Ceiling', 'Roof', 'Wall') else None
+        records.append((slot, surface['Construction_Name'], area))
+    for subsurface, area in zip(subsurfaces, openings):
+        slot = 'Window' if subsurface['Surface_Type'] == 'Window' else None
+        records.append((slot, subsurface['Construction_Name'], area))
+
+    return records
+
+
+def bill_of_quantities(records, values):
+    # Sum the areas per construction for the construction names of one variant
+    quantities = {}
+    for slot, construction, area in records:
+        construction = (values[slot] if slot else construction).upper()
+        quantities[construction] = quantities.get(construction, 0.0) + area
+
+    return quantities
+
+
+def load_quantities(quantities_file):
+    quantities = {}
+    if os.path.isfile(quantities_file):
+        with open(quantities_file, newline='') as f:
+            for row in csv.DictReader(f):
+                quantities.setdefault(row['Building'], {})[row['Construction']] = float(row['Area'])
+
+    return quantities
+
+
+def update_quantities(quantities, variants, rebuild, templates, designs):
+    # Keep the rows of unchanged variants, recompute the rebuilt ones, drop variants no longer in the study
+    compiled = {}
+    for variant in rebuild:
+        key = (variant['Geometry'], variant['Glazing'])
+        if key not in compiled:
+            compiled[key] = compile_quantities(templates[variant['Geometry']], templates[variant['Glazing']])
+        quantities[variant['Name']] = bill_of_quantities(compiled[key], variant_values(variant, designs))
+
+    return {variant['Name']: quantities[variant['Name']] for variant in variants}
+
+
+def save_quantities(quantities_file, quantities):
+    with open(quantities_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Building', 'Construction', 'Area'])
+        for name, constructions in quantities.items():
+            for construction in sorted(constructions):
+                writer.writerow([name, construction, '{:.4f}'.format(constructions[construction])])
+
+    return quantities_file
+
+
+def file_hash(file_name):
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def hash_templates(idf_path, variants):
+    # Content hash of every template file the variants are built from
+    template_names = sorted({'skp_data'} | {v['Geometry'] for v in variants} | {v['Glazing'] for v in variants})
+    template_hashes = {}
+    for name in template_names:
+        template_hashes[name] = file_hash('{}/{}.idf'.format(idf_path, name))
+
+    return template_hashes
+
+
+def variant_inputs(variant, designs, template_hashes):
+    # Hash of everything that ends up in the generated file of one variant
+    inputs = {'variant': variant,
+              'designs': designs,
+              'templates': [template_hashes[name] for name in ('skp_data', variant['Geometry'], variant['Glazing'])]}
+
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(manifest_file):
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+
+    return {}
+
+
+def save_manifest(manifest_file, manifest):
+    temp_file = '{}.tmp'.format(manifest_file)
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_file, manifest_file)
+
+    return manifest_file
+
+
+def stale_variants(variants, manifest, template_hashes, save_path):
+    # A variant is stale when its inputs changed, or its file is missing or was edited since it was generated
+    stale = []
+    for variant in variants:
+        entry = manifest.get(variant['Name'])
+        idf_file = '{}/{}.idf'.format(save_path, variant['Name'])
+        if (entry is None or entry['inputs'] != variant_inputs(variant, len(variants), template_hashes)
+                or not os.path.isfile(idf_file) or entry['output'] != file_hash(idf_file)):
+            stale.append(variant)
+
+    return stale
+
+
+def update_manifest(manifest, variants, template_hashes, save_path):
+    # Variants dropped from the design space are dropped from the manifest as well
+    updated = {}
+    for variant in variants:
+        inputs = variant_inputs(variant, len(variants), template_hashes)
+        entry = manifest.get(variant['Name'])
+        if entry is None or entry['inputs'] != inputs:
+            entry = {'inputs': inputs, 'output': file_hash('{}/{}.idf'.format(save_path, variant['Name']))}
+        updated[variant['Name']] = entry
+
+    return updated
+
+
+def energyplus_paths():
+    # Check for operating system and setup appropriate energyplus path, shared by ep_1setup and ep_2run
+    # so both stages use the same IDD.
+    # The ENERGYPLUS environment variable points to another executable, e.g. ENERGYPLUS=./ep_stub.py
+    if platform == "linux" or platform == "linux2":
+        print('Linux operating system identified.\nIDD path setup completed.')
+        ep_path = '/usr/local/EnergyPlus-8-8-0/energyplus'
+        idd_path = '/usr/local/EnergyPlus-8-8-0/Energy+.idd'
+    elif platform == "darwin":
+        print('Mac operating system identified.\nIDD path setup completed.')
+        ep_path = '/Applications/EnergyPlus-8-8-0/energyplus'
+        idd_path = '/Applications/EnergyPlus-8-8-0/Energy+.idd'
+    elif platform == "win32":
+        print('Windows operating system identified.\nIDD path setup completed.')
+        ep_path = 'C:/EnergyPlusV8-8-0/energyplus.exe'
+        idd_path = 'C:/EnergyPlusV8-8-0/Energy+.idd'
+
+    if os.environ.get('ENERGYPLUS'):
+        ep_path = os.path.abspath(os.environ['ENERGYPLUS'])
+        idd_path = os.path.join(os.path.dirname(ep_path), 'Energy+.idd')
+        if not os.path.isfile(idd_path):
+            # Without an EnergyPlus install next to it (the stub), use the 8.8 IDD that comes with eppy
+            idd_path = os.path.join(os.path.dirname(eppy.__file__), 'resources', 'iddfiles', 'Energy+V8_8_0.idd')
+        print('EnergyPlus executable: {}'.format(ep_path))
+
+    return ep_path, idd_path
+
+
+def setup_idd(idd_path, cache_path='./Models/cache/idd'):
+    # Load the parsed IDD from a pickle keyed by the IDD path, version and file stamp.
+    # Parsing Energy+.idd takes seconds, reading the pickle takes a fraction of that.
+    version = '.'.join(str(i) for i in iddversiontuple(idd_path))
+    stat = os.stat(idd_path)
+    key = '{}|{}|{}|{}'.format(os.path.abspath(idd_path), version, stat.st_size, stat.st_mtime_ns)
+    cache_file = '{}/idd_{}_{}.pickle'.format(cache_path, version, hashlib.sha256(key.encode()).hexdigest()[:16])
+
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            block, commdct, idd_index, version_tuple = pickle.load(f)
+    else:
+        block, commlst, commdct, idd_index = extractidddata(idd_path)
+        version_tuple = iddversiontuple(idd_path)
+        os.makedirs(cache_path, exist_ok=True)
+        # Write to a temporary name first so concurrent workers never read a partial file
+        temp_file = '{}.{}'.format(cache_file, os.getpid())
+        with open(temp_file, 'wb') as f:
+            pickle.dump((block, commdct, idd_index, version_tuple), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+
+    IDF.setiddname(idd_path)
+    IDF.setidd(commdct, idd_index, block, version_tuple)
+
+    return cache_file
+
+
+def default_design_space():
+    # Design space of the original 16 building study
+    # Factors are expanded in the listed order, the last factor varies fastest.
+    # A factor is either a list of levels or a {'min', 'max', 'steps'} range of numbers.
+    # Levels given as dicts are merged into the variant, which keeps dependent factors together.
+    design_space = {
+        'group': 'ss1',
+        'method': 'full',   # Options: full, fractional, lhs
+        'fraction': 2,      # Fractional only: keep 1/fraction of the full factorial
+        'samples': 1000,    # LHS only: number of variants to draw
+        'seed': 1,          # LHS only: random seed for reproducible samples
+        'outputs': 'minimal',   # Options: full (output objects of the data template), minimal (what ep_3results reads)
+        'factors': {
+            'Model': [{'Geometry': 'skp_01', 'Glazing': 'skp_01', 'Generator': 'generate_idf'},
+                      {'Geometry': 'skp_01', 'Glazing': 'skp_05', 'Generator': 'generate_idf'},
+                      {'Geometry': 'skp_09', 'Glazing': 'skp_09', 'Generator': 'generate_idf3'},
+                      {'Geometry': 'skp_09', 'Glazing': 'skp_13', 'Generator': 'generate_idf3'}],
+            'North_Axis': [0],
+            'Window': ['Window A', 'Window B'],
+            'Wall': ['Wall A', 'Wall B'],
+        },
+    }
+
+    return design_space
+
+
+def load_design_space(spec_file):
+    # Read a design space spec saved as json, with the same layout as default_design_space()
+    with open(spec_file) as f:
+        design_space = json.load(f)
+
+    return design_space
+
+
+def factor_levels(levels):
+    # Numeric ranges are discretized into evenly spaced levels
+    if isinstance(levels, dict):
+        steps = levels.get('steps', 2)
+        if steps < 2:
+            return [levels['min']]
+        width = (levels['max'] - levels['min']) / (steps - 1)
+        return [levels['min'] + width * i for i in range(steps)]
+
+    return list(levels)
+
+
+def expand_design_space(design_space):
+    method = design_space.get('method', 'full')
+    factors = design_space['factors']
+    names = list(factors.keys())
+    levels = [factor_levels(factors[name]) for name in names]
+
+    if method in ('full', 'fractional'):
+        # Full factorial as level indices, last factor varies fastest
+        runs = itertools.product(*[range(len(level)) for level in levels])
+        if method == 'fractional':
+            # Regular 1/fraction fraction: keep runs whose level indices sum to 0 modulo the fraction.
+            # For two-level factors and a fraction of 2 this is the classic half fraction I = ABC...
+            fraction = design_space.get('fraction', 2)
+            runs = [run for run in runs if sum(run) % fraction == 0]
+        points = [[level[i] for level, i in zip(levels, run)] for run in runs]
+    elif method == 'lhs':
+        # Latin hypercube: every factor is split into n equal strata and each stratum is sampled once
+        samples = design_space.get('samples', 1000)
+        rng = random.Random(design_space.get('seed'))
+        columns = []
+        for name, level in zip(names, levels):
+            strata = list(range(samples))
+            rng.shuffle(strata)
+            column = []
+            for stratum in strata:
+                u = (stratum + rng.random()) / samples
+                if isinstance(factors[name], dict):
+                    column.append(factors[name]['min'] + u * (factors[name]['max'] - factors[name]['min']))
+                else:
+                    column.append(level[int(u * len(level))])
+            columns.append(column)
+        points = [list(point) for point in zip(*columns)]
+    else:
+        raise ValueError('Unknown design space method: {}'.format(method))
+
+    variants = []
+    for design, point in enumerate(points, start=1):
+        variant = {'Design': design,
+                   'Name': '{}_{:02d}'.format(design_space['group'], design),
+                   'North_Axis': 0,
+                   'Floor': 'Slab A',
+                   'Ceiling': 'Slab A',
+                   'Roof': 'Roof A',
+                   'Outputs': design_space.get('outputs', 'full')}
+        for name, value in zip(names, point):
+            if isinstance(value, dict):
+                variant.update(value)
+            else:
+                variant[name] = value
+        variants.append(variant)
+
+    return variants
+
+
+def save_variant_table(variants, file_name):
+    # Record which factor levels went into each design for the sensitivity analysis
+    columns = []
+    for variant in variants:
+        columns += [key for key in variant if key not in columns]
+
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(variants)
+
+    return file_name
+
+
 if __name__ == "__main__": main()
\ No newline at end of file
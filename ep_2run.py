@@ -1,17 +1,47 @@
 #!/usr/Anaconda3/bin/python3
 # ep_2run.py by Vaclav Hasik
 
-from sys import platform
+from sys import platform, argv, executable
 import os
 import timeit
-from eppy.modeleditor import IDF
 import subprocess
 import matplotlib.pyplot as plt
 import time
 import humanfriendly
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import statistics
+import threading
+import sqlite3
+import hashlib
+import json
+import re
+import datetime
+import zipfile
+import asyncio
+import functools
+import csv
+import multiprocessing
+import socket
+import secrets
+import queue
+from multiprocessing.managers import BaseManager
+import ep_1setup
+import ep_3results
 
 plt.style.use('ggplot')
 
+# Serializes access to the job ledger and the simulation cache from the simulation threads
+LEDGER_LOCK = threading.Lock()
+CACHE_LOCK = threading.Lock()
+TELEMETRY_LOCK = threading.Lock()
+# EnergyPlus version of each executable, part of the simulation cache key
+EP_VERSIONS = {}
+# Weeks of the screening runs, (month, day) of their first day: one per season
+SCREENING_WEEKS = [(1, 15), (4, 15), (7, 15), (10, 15)]
+
 '''
 MAIN BODY
 Pseudo-code:
@@ -27,45 +57,25 @@ def main():
     start = timeit.default_timer()
 
     # Check for operating system and setup appropriate energyplus path
-    if platform == "linux" or platform == "linux2":
-        print('Linux operating system identified... sorry, it is not supported.')
-    elif platform == "darwin":
-        print('Mac operating system identified.\nIDD path setup completed.')
-        ep_path = '/Applications/EnergyPlus-8-8-0/energyplus'
-        idd_path = '/Applications/EnergyPlus-8-8-0/Energy+.idd'
-    elif platform == "win32":
-        print('Windows operating system identified.')
-        ep_path = 'C:/EnergyPlusV8-8-0/energyplus.exe'
-        idd_path = 'C:/EnergyPlusV8-8-0/Energy+.idd'
-
-    # Setup idd file
-    IDF.setiddname(idd_path)
+    ep_path, idd_path = ep_1setup.energyplus_paths()
+
+    # Setup idd file from the pre-parsed cache
+    ep_1setup.setup_idd(idd_path)
     print('IDD path setup completed.')
-    # Specify weather file ==================================
+    # Specify weather files ================================
+    # Every design is simulated with every location: a single .epw, a list of .epw files,
+    # or 'all' for every .epw file in the weather directory
     weather_path = './Data/Weather/'
-    weather_file = 'PHL.epw'
-    print('\nWeather file path: {}{}'.format(weather_path, weather_file))
-    time.sleep(1)   # pause 1 second
-    weather_locations = [weather_file]
-
-    # Automating runs for multiple locations:
-    '''
-    weather_extension = '.epw'
-    weather_files = [f for f in os.listdir(weather_path) if (f.endswith(weather_extension))]
-    weather_count = len(weather_files)
-    print('There are {} epw files in the "{}" directory.'.format(weather_count, weather_path))
-    weather_locations = []
-    for name in weather_files:
-        split_name = name.split(".")
-        weather_locations.append(split_name[0])
-    '''
+    weather_files = 'PHL.epw'
+    weather_locations = select_weather(weather_path, weather_files)
+    print('\nWeather file path: {}'.format(weather_path))
+    print('There are {} weather locations in the sweep: {}'.format(len(weather_locations), weather_locations))
 
     # Specify idf file ======================================
     idf_group = 'ss2'
 
     idf_path = './Models/{}_idfs/'.format(idf_group)
     selection = select_run().lower()
-    time.sleep(1)   # pause 1 second
 
     if selection in 'single':
         idf_design = 1
@@ -73,6 +83,12 @@ def main():
         print('\nInput file path: {}{}'.format(idf_path, idf_name))
         idf_list = [idf_name]
         idf_count = 1
+    elif selection in 'direct':
+        # Generate the designs in memory and simulate them without an intermediate idf directory
+        design_space, variants = ep_1setup.load_study('./Models/design_space.json')
+        templates = ep_1setup.load_templates('./Models/templates', variants)
+        idf_group = design_space['group']
+        idf_count = len(variants)
     elif selection in 'batch':
         idf_extension = '.idf'
         idf_list = [f for f in os.listdir(idf_path) if f.endswith(idf_extension)]
@@ -80,25 +96,94 @@ def main():
         print('\nThere are {} idf files in the "{}" directory.'.format(idf_count, idf_path))
         for i in idf_list:
             print(i)
-            time.sleep(.1)
     else:
         print('Invalid entry. Terminating.')
 
     # Specify output location ===============================
     output_path = './Models/{}_output/'.format(idf_group)
-    time.sleep(1)   # pause 1 second
-
-    # Run EnergyPlus simulations
-    print('\nAccessing EnergyPlus')
-    time.sleep(1)
+    os.makedirs(output_path, exist_ok=True)
+    workers = os.cpu_count()    # Number of concurrent EnergyPlus simulations
+    # Results of identical IDF + EPW + EnergyPlus version runs are shared across batches and studies
+    cache = {'path': './Models/cache/simulations', 'limit': 20 * 1024 ** 3}   # Set to None to always simulate
+    # Wall-clock limit per run (seconds), retries of failed runs, and relaunch of runs slower than 3x the median
+    limits = {'timeout': 4 * 3600, 'retries': 2, 'straggler': 3.0, 'straggler_after': 60}
+    # Simulations run in tmpfs where there is one, and only the whitelisted outputs of each run are kept,
+    # compressed into <design>_<location>.zip in the output directory
+    scratch_path = '/dev/shm' if os.path.isdir('/dev/shm') else None   # None: the system temporary directory
+    keep = ['Table.xml', '.err']    # Add '.sql' to keep the SQLite output, None keeps every output file unpacked
+    # Pipeline mode: results extraction and LCA of every run start as soon as it finishes, and the rows stream
+    # into ./Results/<group>_summary__master.csv while the other runs are still simulating
+    pipeline = None     # Options: None, {'study_period': 30, 'processes': 2}
+    # Resource use of every EnergyPlus run, summarized with: python ep_2run.py telemetry <telemetry file>
+    telemetry = '{}{}_telemetry.jsonl'.format(output_path, idf_group)
+    # Distributed batch: serve the jobs to workers on any number of hosts instead of running them here
+    # Workers need the key from EP_BROKER_KEY (a random one is printed when it is not set)
+    broker = None   # Options: None, {'address': (broker_host(), 50000), 'outputs': ['Table.xml', '.err']}
 
+    # List every simulation of the batch, with a hash of its inputs to spot changed models.
+    # Variants of the design space are rendered when their jobs are dispatched, jobs only hold how to render them.
+    if selection in 'direct':
+        compiled = ep_1setup.compile_variants(variants, templates)
+        renders = {variant['Name']: functools.partial(ep_1setup.render_variant, compiled, variant, idf_count)
+                   for variant in variants}
+        idf_hashes = {name: hashlib.sha256(render().encode('latin-1')).hexdigest() for name, render in renders.items()}
+    jobs = []
     for location in weather_locations:
-        for design in range(1, idf_count+1):
-            print('\nSimulation of {}_{:02d} is beginning\n'.format(idf_group, design))
-            time.sleep(2)  # pause 2 seconds
-            idf_name = '{}_{:02d}'.format(idf_group, design)
-            run_ep(ep_path, output_path, idf_path, idf_name, weather_path, location)
-            print('\nSimulation of {}_{:02d} completed.\n=============================\n\n\n'.format(idf_group, design))
+        weather_hash = ep_1setup.file_hash('{}{}'.format(weather_path, location))
+        if selection in 'direct':
+            for variant in variants:
+                jobs.append({'idf_name': variant['Name'], 'weather_file': location, 'idf_text': None,
+                             'render': renders[variant['Name']],
+                             'inputs': '{}|{}'.format(idf_hashes[variant['Name']], weather_hash)})
+        else:
+            for design in range(1, idf_count+1):
+                idf_name = '{}_{:02d}'.format(idf_group, design)
+                idf_hash = ep_1setup.file_hash('{}{}.idf'.format(idf_path, idf_name))
+                jobs.append({'idf_name': idf_name, 'weather_file': location, 'idf_text': None,
+                             'inputs': '{}|{}'.format(idf_hash, weather_hash)})
+
+    # Optional screening pass: runs of a few representative weeks rank the designs cheaply,
+    # and only the selected candidates go on to the full annual simulation
+    # 'top': the k lowest energy intensities per location, 'pareto': the trade-off between the energy intensity
+    # in every location and the embodied impacts / material cost of the bills of quantities from ep_1setup
+    screening = None    # Options: None, {'mode': 'top', 'k': 20}, {'mode': 'pareto', 'objectives': ['LCI_GWP', 'Cost']}
+    if screening is not None:
+        # Bills of quantities of the embodied objectives: from the templates in Direct mode,
+        # otherwise from the file ep_1setup saves next to the idf files
+        quantities = None
+        if screening['mode'] == 'pareto':
+            if selection in 'direct':
+                quantities = ep_1setup.update_quantities({}, variants, variants, templates, idf_count)
+            else:
+                quantities = ep_1setup.load_quantities('{}{}_quantities.csv'.format(idf_path, idf_group))
+        jobs = screen_jobs(ep_path, './Models/{}_screening/'.format(idf_group), idf_group, idf_path, weather_path,
+                           jobs, workers, cache, screening, limits, telemetry, scratch_path, quantities)
+
+    # Resume from the job ledger, only jobs that are not done yet (or whose inputs changed) are run
+    fresh = False   # Set to True to forget the ledger and rerun the whole batch
+    ledger = open_ledger('{}{}_jobs.sqlite'.format(output_path, idf_group), fresh)
+    pending = ledger_pending(ledger, jobs)
+    print('\n{} of {} simulations already done, {} to run.'.format(len(jobs) - len(pending), len(jobs), len(pending)))
+
+    # Run EnergyPlus simulations
+    if broker is not None:
+        print('\nServing the batch to remote workers')
+        run_broker(output_path, idf_path, weather_path, pending, broker, ledger, limits, telemetry)
+    elif pipeline is not None:
+        print('\nAccessing EnergyPlus with {} workers, LCA of the results with {} processes'.format(
+            workers, pipeline['processes']))
+        os.makedirs('./Results', exist_ok=True)
+        lca = dict(pipeline, impact_categories=ep_3results.TRACI_2_1, electric_cost=ep_3results.electricity_price())
+        asyncio.run(run_pipeline(ep_path, output_path, idf_path, weather_path, jobs, pending, workers,
+                                 './Results/{}_summary__master.csv'.format(idf_group), lca, ledger, cache, limits,
+                                 telemetry, scratch_path, keep, idf_group))
+    else:
+        print('\nAccessing EnergyPlus with {} workers'.format(workers))
+        run_batch(ep_path, output_path, idf_path, weather_path, pending, workers, ledger, cache, limits, telemetry,
+                  scratch_path, keep)
+    ledger.close()
+    if os.path.isfile(telemetry):
+        summarize_telemetry(telemetry)
 
     print('\nTotal run time:')
     stop = timeit.default_timer()
@@ -111,13 +196,53 @@ FUNCTIONS
 '''
 
 
-def run_ep(ep_path, output_path, idf_path, idf_name, weather_path, weather_file):
-    subprocess.call([ep_path,
-                     '-d', '{}'.format(output_path),
-                     '-p', '{}'.format(idf_name),
-                     '-s', 'C',
-                     '-w', '{}{}'.format(weather_path, weather_file),
-                     '-x', '{}{}.idf'.format(idf_path, idf_name)])
+def energyplus_command(ep_path):
+    # Python scripts such as ep_stub.py run with this interpreter, so they work on Windows as well
+    if ep_path.endswith('.py'):
+        return [executable, ep_path]
+
+    return [ep_path]
+
+
+def run_ep(ep_path, output_path, idf_path, idf_name, weather_path, weather_file, cwd=None, output_prefix=None,
+           design_day=False, timeout=None, cancel=None, usage=None):
+    # Returns the exit status, or None when the run was cancelled.
+    # A run longer than timeout seconds is killed and raises subprocess.TimeoutExpired.
+    # A usage dict is filled with the wall time, CPU time, peak RSS, output bytes and exit status of the run.
+    if usage is not None:
+        outputs_before = set(os.listdir(output_path))
+    process = subprocess.Popen(energyplus_command(ep_path) +
+                               ['-d', '{}'.format(output_path),
+                                '-p', '{}'.format(output_prefix or idf_name),
+                                '-s', 'C',
+                                '-w', '{}{}'.format(weather_path, weather_file)] +
+                               (['-D'] if design_day else []) +
+                               ['-x', '{}{}.idf'.format(idf_path, idf_name)], cwd=cwd)
+    started = time.time()
+    returncode, rusage = None, None
+    try:
+        while True:
+            returncode, rusage = wait_ep(process, 0.2)
+            if returncode is not None:
+                break
+            if cancel is not None and cancel.is_set():
+                process.kill()
+                returncode, rusage = wait_ep(process)
+                return None
+            if timeout is not None and time.time() - started > timeout:
+                process.kill()
+                returncode, rusage = wait_ep(process)
+                raise subprocess.TimeoutExpired(process.args, timeout)
+    finally:
+        if usage is not None:
+            usage['wall_time'] = time.time() - started
+            usage['exit_status'] = returncode
+            if rusage is not None:
+                usage['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+                # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+                usage['peak_rss'] = rusage.ru_maxrss * (1 if platform == 'darwin' else 1024)
+            usage['output_bytes'] = sum(os.path.getsize(os.path.join(output_path, f))
+                                        for f in os.listdir(output_path) if f not in outputs_before)
 
     # ENERGYPLUS SETTINGS
     # -a, --annual                 Force annual simulation
@@ -139,11 +264,981 @@ def run_ep(ep_path, output_path, idf_path, idf_name, weather_path, weather_file)
     #                              directory)
     # -x, --expandobjects          Run ExpandObjects prior to simulation
 
+    return returncode
+
+
+def run_job(ep_path, output_path, idf_path, idf_name, weather_path, weather_file, idf_text=None,
+            scratch_path=None, cache=None, design_day=False, timeout=None, cancel=None, claim=None,
+            telemetry=None, keep=None, usage=None):
+    # Run one simulation in its own scratch directory, so concurrent runs never share files,
+    # then move the outputs to the output directory of the group.
+    # Models handed over in memory (idf_text) are written straight into the scratch directory.
+    # With a cache ({'path', 'limit'}) identical IDF + EPW + EnergyPlus version runs are restored instead,
+    # with keep only the kept outputs are stored in it.
+    # Failed runs raise RuntimeError and leave their .err file in the output directory.
+    # When several copies of a run race, only the one that acquires the claim lock keeps its outputs,
+    # the lock is released again if keeping them fails so that a retry can claim the run.
+    # Every EnergyPlus run is recorded in the telemetry ledger file, if one is given,
+    # and its resource use is filled into the usage dict, which stays empty for runs restored from the cache.
+    # With keep (file name endings) only those outputs are kept, compressed into <prefix>.zip.
+    # Outputs are named per (design, location) so the runs of a sweep do not overwrite each other
+    prefix = output_prefix(idf_name, weather_file)
+    os.makedirs(output_path, exist_ok=True)
+    if cache is not None:
+        if idf_text is None:
+            with open('{}{}.idf'.format(idf_path, idf_name), encoding='latin-1') as f:
+                keys = cache_keys(ep_path, f.read(), '{}{}'.format(weather_path, weather_file), design_day, keep)
+        else:
+            keys = cache_keys(ep_path, idf_text, '{}{}'.format(weather_path, weather_file), design_day, keep)
+        cache_key = keys[0]
+        output_files = None
+        if keep is None:
+            output_files = cache_restore(cache['path'], cache_key, prefix, output_path)
+        else:
+            restore_path = tempfile.mkdtemp(prefix='{}_'.format(prefix), dir=scratch_path)
+            try:
+                for key in keys:
+                    output_files = cache_restore(cache['path'], key, prefix, restore_path)
+                    if output_files is not None:
+                        output_files = archive_outputs(restore_path, prefix, output_path, keep)
+                        break
+            finally:
+                shutil.rmtree(restore_path, ignore_errors=True)
+        if output_files is not None:
+            print('Simulation of {} with {} restored from the cache.'.format(idf_name, weather_file))
+            return output_files
+
+    run_path = tempfile.mkdtemp(prefix='{}_'.format(prefix), dir=scratch_path)
+    if usage is None:
+        usage = {}
+    status = 'failed'
+    try:
+        if idf_text is not None:
+            ep_1setup.write_idf(run_path, idf_text, idf_name)
+            idf_path = run_path
+        try:
+            returncode = run_ep(ep_path, run_path + os.sep, os.path.abspath(idf_path) + os.sep, idf_name,
+                                os.path.abspath(weather_path) + os.sep, weather_file, cwd=run_path,
+                                output_prefix=prefix, design_day=design_day, timeout=timeout, cancel=cancel,
+                                usage=usage)
+        except subprocess.TimeoutExpired:
+            status = 'timeout'
+            raise RuntimeError('timed out after {} seconds'.format(timeout))
+        if returncode is None:
+            status = 'cancelled'
+            raise RuntimeError('cancelled')
+
+        error = run_error(run_path, prefix, returncode)
+        if error is not None:
+            if os.path.isfile(os.path.join(run_path, '{}.err'.format(prefix))):
+                shutil.copy2(os.path.join(run_path, '{}.err'.format(prefix)), output_path)
+            raise RuntimeError(error)
+        status = 'done'
+        if claim is not None and not claim.acquire(blocking=False):
+            status = 'superseded'
+            return None
+
+        try:
+            if idf_text is not None:
+                os.remove(os.path.join(run_path, '{}.idf'.format(idf_name)))
+            if cache is not None:
+                cache_store(cache['path'], cache_key, prefix, run_path, cache['limit'], keep)
+
+            if keep is None:
+                output_files = []
+                for f in os.listdir(run_path):
+                    shutil.move(os.path.join(run_path, f), os.path.join(output_path, f))
+                    output_files.append(os.path.join(output_path, f))
+            else:
+                output_files = archive_outputs(run_path, prefix, output_path, keep)
+        except Exception:
+            status = 'failed'
+            if claim is not None:
+                claim.release()
+            raise
+    finally:
+        shutil.rmtree(run_path, ignore_errors=True)
+        if telemetry is not None and usage:
+            record_telemetry(telemetry, idf_name, weather_file, design_day, status, usage)
+
+    return output_files
+
+
+def archive_outputs(run_path, prefix, output_path, keep):
+    # Compress the outputs of a run whose names end with one of keep into <prefix>.zip, the rest is dropped
+    archive_file = os.path.join(output_path, '{}.zip'.format(prefix))
+    temp_file = '{}.{}.tmp'.format(archive_file, threading.get_ident())
+    with zipfile.ZipFile(temp_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for f in sorted(os.listdir(run_path)):
+            if f.endswith(tuple(keep)):
+                archive.write(os.path.join(run_path, f), f)
+    os.replace(temp_file, archive_file)
+
+    return [archive_file]
+
+
+def wait_ep(process, poll=None):
+    # Reap the EnergyPlus process, with its resource usage where the OS reports it (not on Windows).
+    # Without poll block until it exits, otherwise return (None, None) if it is still running after poll seconds.
+    if hasattr(os, 'wait4'):
+        pid, status, rusage = os.wait4(process.pid, 0 if poll is None else os.WNOHANG)
+        if not pid:
+            time.sleep(poll)
+            return None, None
+        process.returncode = os.waitstatus_to_exitcode(status)
+        return process.returncode, rusage
+    try:
+        process.wait(timeout=poll)
+    except subprocess.TimeoutExpired:
+        return None, None
+
+    return process.returncode, None
+
+
+def record_telemetry(telemetry_file, idf_name, weather_file, design_day, status, usage):
+    # One JSON line per EnergyPlus run, appended to the telemetry ledger
+    record = {'idf_name': idf_name, 'weather_file': weather_file, 'design_day': design_day, 'status': status,
+              'exit_status': usage.get('exit_status'), 'started': round(time.time() - usage['wall_time'], 3),
+              'wall_time': round(usage['wall_time'], 3), 'cpu_time': usage.get('cpu_time'),
+              'peak_rss': usage.get('peak_rss'), 'output_bytes': usage.get('output_bytes'),
+              'host': socket.gethostname(), 'cores': os.cpu_count()}
+    with TELEMETRY_LOCK:
+        with open(telemetry_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def summarize_telemetry(telemetry_file, slowest=10):
+    # Throughput, slowest designs and per-core utilisation of the runs in a telemetry ledger
+    with open(telemetry_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        print('No simulations recorded in {}.'.format(telemetry_file))
+        return
+    done = [r for r in records if r['status'] == 'done']
+
+    print('\nTELEMETRY SUMMARY: {}'.format(telemetry_file))
+    print('{} EnergyPlus runs: {}'.format(len(records), ', '.join(
+        '{} {}'.format(sum(r['status'] == status for r in records), status)
+        for status in sorted(set(r['status'] for r in records)))))
+    busy = busy_time(records)
+    print('Busy time: {}, throughput: {:.1f} completed runs per hour'.format(
+        humanfriendly.format_timespan(busy), 3600 * len(done) / busy if busy else 0))
+    if done:
+        wall_times = [r['wall_time'] for r in done]
+        print('Completed run time: median {}, max {}'.format(
+            humanfriendly.format_timespan(statistics.median(wall_times)),
+            humanfriendly.format_timespan(max(wall_times))))
+        peak_rss = [r['peak_rss'] for r in done if r['peak_rss'] is not None]
+        if peak_rss:
+            print('Peak memory per run: median {}, max {}'.format(
+                humanfriendly.format_size(statistics.median(peak_rss)), humanfriendly.format_size(max(peak_rss))))
+        print('Output written: {}'.format(humanfriendly.format_size(sum(r['output_bytes'] or 0 for r in done))))
+
+    # CPU time over the busy time of each host and its cores
+    print('\nHost                           Runs   CPU time   Cores   Utilisation per core')
+    for host in sorted(set(r['host'] for r in records)):
+        host_records = [r for r in records if r['host'] == host]
+        cores = max(r['cores'] for r in host_records)
+        cpu_time = sum(r['cpu_time'] or 0 for r in host_records)
+        host_busy = busy_time(host_records)
+        print('{:<30} {:>5} {:>9.1f}s {:>7} {:>21.1%}'.format(
+            host, len(host_records), cpu_time, cores, cpu_time / (host_busy * cores) if host_busy else 0))
+
+    print('\nSlowest runs:')
+    for r in sorted(records, key=lambda r: r['wall_time'], reverse=True)[:slowest]:
+        print('{:<20} {:<20} {:>12} {}'.format(r['idf_name'], r['weather_file'],
+                                               humanfriendly.format_timespan(r['wall_time']), r['status']))
+
+
+def busy_time(records):
+    # Length of the union of the run intervals, so idle time between batches is not counted
+    busy = 0
+    end = None
+    for start, stop in sorted((r['started'], r['started'] + r['wall_time']) for r in records):
+        if end is None or start > end:
+            busy += stop - start
+            end = stop
+        elif stop > end:
+            busy += stop - end
+            end = stop
+
+    return busy
+
+
+def run_error(run_path, prefix, returncode):
+    # EnergyPlus can exit with status 0 after a fatal error, so the .err file is checked as well
+    err_file = os.path.join(run_path, '{}.err'.format(prefix))
+    if not os.path.isfile(err_file):
+        return 'no .err file was written (exit status {})'.format(returncode)
+    with open(err_file, encoding='latin-1') as f:
+        err_text = f.read()
+    fatal = [line.strip() for line in err_text.splitlines() if '** Fatal' in line or '**  Fatal' in line]
+    if returncode != 0:
+        return 'EnergyPlus exited with status {} {}'.format(returncode, fatal[:1])
+    if fatal or 'EnergyPlus Completed Successfully' not in err_text:
+        return 'EnergyPlus did not complete successfully {}'.format(fatal[:1])
+
+    return None
+
+
+def output_prefix(idf_name, weather_file):
+    # Prefix of the output files of one (design, location) run, e.g. ss1_01_PHL
+    return '{}_{}'.format(idf_name, os.path.splitext(weather_file)[0])
+
+
+def select_weather(weather_path, weather_files):
+    if weather_files == 'all':
+        return sorted(f for f in os.listdir(weather_path) if f.endswith('.epw'))
+    elif isinstance(weather_files, str):
+        return [weather_files]
+
+    return list(weather_files)
+
+
+def canonical_idf(idf_text):
+    # Drop comments, whitespace and line layout so formatting differences do not change the cache key
+    objects = []
+    for obj in re.sub(r'!.*', '', idf_text).split(';'):
+        fields = [field.strip() for field in obj.split(',')]
+        if any(fields):
+            objects.append(','.join(fields))
+
+    return ';\n'.join(objects)
+
+
+def energyplus_version(ep_path):
+    # Version reported by the executable, asked once per executable
+    if ep_path not in EP_VERSIONS:
+        try:
+            output = subprocess.run(energyplus_command(ep_path) + ['--version'], capture_output=True, text=True,
+                                    timeout=60).stdout
+        except (OSError, subprocess.SubprocessError):
+            output = ''
+        EP_VERSIONS[ep_path] = output.strip() or ep_path
+
+    return EP_VERSIONS[ep_path]
+
+
+def simulation_key(ep_path, idf_text, weather_file, design_day=False):
+    sha = hashlib.sha256()
+    sha.update(energyplus_version(ep_path).encode())
+    sha.update(b'design-day' if design_day else b'annual')
+    sha.update(ep_1setup.file_hash(weather_file).encode())
+    sha.update(canonical_idf(idf_text).encode('latin-1'))
+
+    return sha.hexdigest()
+
+
+def cache_keys(ep_path, idf_text, weather_file, design_day=False, keep=None):
+    # Cache entries a run can be restored from. With keep the first one holds only the kept outputs and its key
+    # includes them, the second one is the entry of the same run stored with all of its outputs.
+    key = simulation_key(ep_path, idf_text, weather_file, design_day)
+    if keep is None:
+        return [key]
+
+    return [hashlib.sha256('{}|keep:{}'.format(key, '|'.join(sorted(keep))).encode()).hexdigest(), key]
+
+
+def open_cache(cache_path):
+    # Index of the cached runs with their size and last use, for LRU eviction
+    os.makedirs(cache_path, exist_ok=True)
+    index = sqlite3.connect(os.path.join(cache_path, 'index.sqlite'), timeout=60)
+    index.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, used REAL)')
+
+    return index
+
+
+def cache_restore(cache_path, cache_key, prefix, output_path):
+    # Copy a cached run to the output directory under this job's prefix, None on a miss
+    entry_path = os.path.join(cache_path, cache_key)
+    with CACHE_LOCK:
+        index = open_cache(cache_path)
+        hit = index.execute('SELECT key FROM entries WHERE key = ?', (cache_key,)).fetchone()
+        if hit is None or not os.path.isdir(entry_path):
+            index.close()
+            return None
+        index.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), cache_key))
+        index.commit()
+        index.close()
+
+        output_files = []
+        try:
+            for f in os.listdir(entry_path):
+                # Outputs are stored with the run prefix replaced by '@'
+                output_file = os.path.join(output_path, prefix + f[1:] if f.startswith('@') else f)
+                output_files.append(output_file)
+                shutil.copy2(os.path.join(entry_path, f), output_file)
+        except OSError:
+            # Another study sharing the cache evicted the entry while it was copied, treat it as a miss
+            for output_file in output_files:
+                if os.path.isfile(output_file):
+                    os.remove(output_file)
+            return None
+
+    return output_files
+
+
+def cache_store(cache_path, cache_key, prefix, run_path, limit, keep=None):
+    # Store the outputs of a successful run (only those ending with one of keep, if given),
+    # then evict the least recently used runs above the size limit.
+    # CACHE_LOCK only covers the threads of this process, other processes sharing the cache are handled by
+    # renaming complete entries into place and by cache_restore falling back to a miss.
+    with CACHE_LOCK:
+        index = open_cache(cache_path)
+        entry_path = os.path.join(cache_path, cache_key)
+        if not os.path.isdir(entry_path):
+            temp_path = tempfile.mkdtemp(dir=cache_path)
+            size = 0
+            for f in os.listdir(run_path):
+                if keep is not None and not f.endswith(tuple(keep)):
+                    continue
+                stored = '@' + f[len(prefix):] if f.startswith(prefix) else f
+                shutil.copy2(os.path.join(run_path, f), os.path.join(temp_path, stored))
+                size += os.path.getsize(os.path.join(temp_path, stored))
+            try:
+                os.replace(temp_path, entry_path)
+            except OSError:
+                # Another study sharing the cache stored the same run first
+                shutil.rmtree(temp_path, ignore_errors=True)
+                if not os.path.isdir(entry_path):
+                    raise
+            index.execute('INSERT OR REPLACE INTO entries (key, size, used) VALUES (?, ?, ?)',
+                          (cache_key, size, time.time()))
+
+        total = index.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        for key, size in index.execute('SELECT key, size FROM entries ORDER BY used').fetchall():
+            if total <= limit:
+                break
+            shutil.rmtree(os.path.join(cache_path, key), ignore_errors=True)
+            index.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+        index.commit()
+        index.close()
+
+
+def run_batch(ep_path, output_path, idf_path, weather_path, jobs, workers, ledger=None, cache=None, limits=None,
+              telemetry=None, scratch_path=None, keep=None, on_result=None):
+    # EnergyPlus runs as a separate process, threads are enough to keep the workers busy.
+    # limits: 'timeout' wall-clock seconds per run, 'retries' per failed job, 'straggler' relaunches a second copy
+    # of a run that takes longer than straggler x the median run time (and at least 'straggler_after' seconds)
+    # once no queued jobs are left; the first copy to finish wins and the other one is killed.
+    # on_result(job, output_files) is called as soon as a job is done.
+    if limits is None:
+        limits = {'timeout': None, 'retries': 0, 'straggler': None, 'straggler_after': 60}
+    results = {}
+    queued = deque(jobs)
+    states = {}
+    in_flight = {}
+    durations = []
+    finished = 0
+
+    def submit(job):
+        key = (job['idf_name'], job['weather_file'])
+        if key not in states:
+            states[key] = {'attempts': 0, 'running': 0, 'done': False, 'speculated': False,
+                           'cancel': threading.Event(), 'claim': threading.Lock()}
+        state = states[key]
+        state['attempts'] += 1
+        state['running'] += 1
+        if ledger is not None:
+            ledger_update(ledger, job, 'running')
+        usage = {}
+        future = pool.submit(run_job, ep_path, output_path, idf_path, job['idf_name'], weather_path,
+                             job['weather_file'], job_text(job), scratch_path=scratch_path, cache=cache,
+                             design_day=job.get('design_day', False), timeout=limits['timeout'],
+                             cancel=state['cancel'], claim=state['claim'],
+                             telemetry=telemetry, keep=keep, usage=usage)
+        in_flight[future] = (job, time.time(), usage)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for job in jobs:
+            print('Simulation of {} with {} queued.'.format(job['idf_name'], job['weather_file']))
+
+        while queued or in_flight:
+            while queued and len(in_flight) < workers:
+                submit(queued.popleft())
+
+            # Idle workers and nothing queued: relaunch the stragglers
+            if limits['straggler'] and not queued and len(in_flight) < workers and len(durations) >= 3:
+                threshold = max(limits['straggler'] * statistics.median(durations), limits['straggler_after'])
+                for job, started, usage in list(in_flight.values()):
+                    state = states[(job['idf_name'], job['weather_file'])]
+                    if len(in_flight) < workers and not state['speculated'] and time.time() - started > threshold:
+                        state['speculated'] = True
+                        print('Simulation of {} with {} is a straggler, launching a second copy.'.format(
+                            job['idf_name'], job['weather_file']))
+                        submit(job)
+
+            completed, running = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+            for future in completed:
+                job, started, usage = in_flight.pop(future)
+                state = states[(job['idf_name'], job['weather_file'])]
+                state['running'] -= 1
+                if state['done']:
+                    continue
+                try:
+                    output_files = future.result()
+                    if output_files is None:
+                        # Claimed by a copy that has not finished, or failed after claiming
+                        raise RuntimeError('superseded by another copy that did not complete')
+                except Exception as error:
+                    if state['running']:
+                        # The other copy of a straggler is still running
+                        continue
+                    if state['attempts'] <= limits['retries']:
+                        print('Simulation of {} with {} failed, retrying ({}/{}): {}'.format(
+                            job['idf_name'], job['weather_file'], state['attempts'], limits['retries'], error))
+                        queued.append(job)
+                        continue
+                    state['done'] = True
+                    finished += 1
+                    if ledger is not None:
+                        ledger_update(ledger, job, 'failed')
+                    print('Simulation of {} with {} failed ({}/{}): {}'.format(
+                        job['idf_name'], job['weather_file'], finished, len(jobs), error))
+                    continue
+
+                # First copy to finish: stop the other copy if there is one
+                state['done'] = True
+                state['cancel'].set()
+                # Only simulated runs count towards the median, restored ones take no time
+                if 'wall_time' in usage:
+                    durations.append(usage['wall_time'])
+                finished += 1
+                results[(job['idf_name'], job['weather_file'])] = output_files
+                if ledger is not None:
+                    ledger_update(ledger, job, 'done', output_files)
+                print('Simulation of {} with {} completed ({}/{}).'.format(
+                    job['idf_name'], job['weather_file'], finished, len(jobs)))
+                if on_result is not None:
+                    on_result(job, output_files)
+
+    return results
+
+
+class BrokerManager(BaseManager):
+    # TCP broker shared by the coordinator and the workers of a distributed batch
+    pass
+
+
+class JobBroker:
+    # Job queue of a distributed batch, served by the coordinator to the workers through BrokerManager.
+    # A job handed to a worker is leased: without a result within the lease it goes back to the queue.
+    def __init__(self, weather_path, outputs):
+        self.weather_path = weather_path
+        self.outputs = outputs
+        self.queue = deque()
+        self.leases = {}
+        self.done = set()
+        self.results = queue.Queue()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def put(self, job):
+        with self.lock:
+            self.queue.append(job)
+
+    def get_job(self, worker):
+        with self.lock:
+            while self.queue:
+                job = self.queue.popleft()
+                key = (job['idf_name'], job['weather_file'])
+                if key not in self.done:
+                    self.leases[key] = (job, worker, time.time())
+                    return dict(job, outputs=self.outputs)
+        return None
+
+    def put_result(self, result):
+        with self.lock:
+            key = (result['idf_name'], result['weather_file'])
+            if key in self.done or key not in self.leases:
+                return
+            del self.leases[key]
+            if result['status'] == 'done':
+                self.done.add(key)
+        self.results.put(result)
+
+    def weather(self, weather_file):
+        with open('{}{}'.format(self.weather_path, weather_file), 'rb') as f:
+            return f.read()
+
+    def expire(self, lease):
+        # Jobs of workers that died or lost the connection are queued again
+        with self.lock:
+            expired = [key for key, (job, worker, leased) in self.leases.items() if time.time() - leased > lease]
+            for key in expired:
+                job, worker, leased = self.leases.pop(key)
+                self.queue.append(job)
+        return expired
+
+    def finished(self):
+        return self.closed
+
+
+def run_broker(output_path, idf_path, weather_path, jobs, broker, ledger=None, limits=None, telemetry=None):
+    # Coordinator of a distributed batch: the jobs are served to the workers of any number of hosts
+    # (python ep_2run.py worker <coordinator host>:<port> [workers]), which run EnergyPlus and send back
+    # the broker['outputs'] files in the archive of the run. Workers get the models and weather files from the broker,
+    # no shared disk needed.
+    if limits is None:
+        limits = {'timeout': None, 'retries': 0, 'straggler': None, 'straggler_after': 60}
+    job_broker = JobBroker(weather_path, broker['outputs'])
+    for job in jobs:
+        job_broker.put(broker_job(job, idf_path, limits))
+        if ledger is not None:
+            ledger_update(ledger, job, 'running')
+    jobs = {(job['idf_name'], job['weather_file']): job for job in jobs}
+
+    if broker['address'][0] in ('', '0.0.0.0', '::'):
+        print('Warning: the broker listens on every network interface.')
+    BrokerManager.register('broker', callable=lambda: job_broker)
+    manager = BrokerManager(address=broker['address'], authkey=broker.get('authkey') or broker_authkey(generate=True))
+    server = manager.get_server()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Broker serving {} jobs on {}:{}, start the workers with: '
+          'EP_BROKER_KEY=<key> python ep_2run.py worker {}:{} [workers]'.format(len(jobs), *server.address,
+                                                                              *server.address))
+
+    # Without a time limit per run a worker is presumed lost after a day
+    lease = broker.get('lease') or (limits['timeout'] or 24 * 3600) + 60
+    attempts = {key: 1 for key in jobs}
+    results = {}
+    finished = 0
+    while finished < len(jobs):
+        for key in job_broker.expire(lease):
+            print('Simulation of {} with {} lost its worker, queued again.'.format(*key))
+            if ledger is not None:
+                ledger_update(ledger, jobs[key], 'running')
+        try:
+            result = job_broker.results.get(timeout=1)
+        except queue.Empty:
+            continue
+        key = (result['idf_name'], result['weather_file'])
+        job = jobs[key]
+        if telemetry is not None and result['telemetry']:
+            with TELEMETRY_LOCK:
+                with open(telemetry, 'a') as f:
+                    f.write(result['telemetry'])
+        if result['status'] != 'done':
+            if result['err'] is not None:
+                with open('{}{}.err'.format(output_path, output_prefix(*key)), 'wb') as f:
+                    f.write(result['err'])
+            if attempts[key] <= limits['retries']:
+                print('Simulation of {} with {} failed on {}, retrying ({}/{}): {}'.format(
+                    job['idf_name'], job['weather_file'], result['worker'], attempts[key], limits['retries'],
+                    result['error']))
+                attempts[key] += 1
+                job_broker.put(broker_job(job, idf_path, limits))
+                if ledger is not None:
+                    ledger_update(ledger, job, 'running')
+                continue
+            finished += 1
+            if ledger is not None:
+                ledger_update(ledger, job, 'failed')
+            print('Simulation of {} with {} failed on {} ({}/{}): {}'.format(
+                job['idf_name'], job['weather_file'], result['worker'], finished, len(jobs), result['error']))
+            continue
+
+        output_files = []
+        for name, data in result['files'].items():
+            with open(os.path.join(output_path, name), 'wb') as f:
+                f.write(data)
+            output_files.append(os.path.join(output_path, name))
+        finished += 1
+        results[key] = output_files
+        if ledger is not None:
+            ledger_update(ledger, job, 'done', output_files)
+        print('Simulation of {} with {} completed on {} ({}/{}).'.format(
+            job['idf_name'], job['weather_file'], result['worker'], finished, len(jobs)))
+
+    # Idle workers see the batch is over and exit
+    job_broker.closed = True
+    time.sleep(3)
+    server.stop_event.set()
+
+    return results
+
+
+def broker_job(job, idf_path, limits):
+    # Job as handed to a worker, with the model text instead of a path on the coordinator
+    idf_text = job_text(job, idf_path)
+
+    return {'idf_name': job['idf_name'], 'weather_file': job['weather_file'], 'idf_text': idf_text,
+            'design_day': job.get('design_day', False), 'timeout': limits['timeout']}
+
+
+def job_text(job, idf_path=None):
+    # Model text of a job, rendered now for jobs that carry a render function.
+    # Without idf_path, None for models that run_job reads from the idf directory itself.
+    if job.get('render') is not None:
+        return job['render']()
+    if job['idf_text'] is None and idf_path is not None:
+        with open('{}{}.idf'.format(idf_path, job['idf_name']), encoding='latin-1') as f:
+            return f.read()
+
+    return job['idf_text']
+
+
+def run_worker(address, ep_path, workers=1, scratch_path=None, authkey=None):
+    # Worker of a distributed batch: pull jobs from the coordinator at address (host, port) until the batch is over
+    BrokerManager.register('broker')
+    manager = BrokerManager(address=address, authkey=authkey or broker_authkey())
+    for attempt in range(30):
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            time.sleep(2)
+    else:
+        print('No broker at {}:{}.'.format(*address))
+        return
+    weather_path = tempfile.mkdtemp(prefix='weather_', dir=scratch_path)
+    weather_lock = threading.Lock()
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    print('Worker {} connected to {}:{} with {} simulation slots.'.format(worker, address[0], address[1], workers))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for slot in range(workers):
+                pool.submit(worker_loop, manager, ep_path, weather_path, scratch_path, '{}/{}'.format(worker, slot),
+                            weather_lock)
+    finally:
+        shutil.rmtree(weather_path, ignore_errors=True)
+
+
+def worker_loop(manager, ep_path, weather_path, scratch_path, worker, weather_lock):
+    # One simulation slot of a worker; proxies are not shared between threads
+    job_broker = manager.broker()
+    while True:
+        try:
+            job = job_broker.get_job(worker)
+            if job is None:
+                if job_broker.finished():
+                    break
+                time.sleep(2)
+                continue
+            with weather_lock:
+                if not os.path.isfile(os.path.join(weather_path, job['weather_file'])):
+                    with open(os.path.join(weather_path, job['weather_file']), 'wb') as f:
+                        f.write(job_broker.weather(job['weather_file']))
+        except (EOFError, ConnectionError):
+            # The coordinator is gone
+            break
+
+        run_path = tempfile.mkdtemp(prefix='worker_', dir=scratch_path)
+        telemetry = os.path.join(run_path, 'telemetry.jsonl')
+        result = {'idf_name': job['idf_name'], 'weather_file': job['weather_file'], 'worker': worker,
+                  'status': 'done', 'error': None, 'err': None, 'files': {}, 'telemetry': ''}
+        output_path = os.path.join(run_path, 'output') + os.sep
+        try:
+            output_files = run_job(ep_path, output_path, None, job['idf_name'], weather_path + os.sep,
+                                   job['weather_file'], job['idf_text'], scratch_path=scratch_path,
+                                   design_day=job['design_day'], timeout=job['timeout'], telemetry=telemetry,
+                                   keep=job['outputs'])
+            for output_file in output_files:
+                with open(output_file, 'rb') as f:
+                    result['files'][os.path.basename(output_file)] = f.read()
+        except Exception as error:
+            result['status'] = 'failed'
+            result['error'] = str(error)
+            err_file = '{}{}.err'.format(output_path, output_prefix(job['idf_name'], job['weather_file']))
+            if os.path.isfile(err_file):
+                with open(err_file, 'rb') as f:
+                    result['err'] = f.read()
+        if os.path.isfile(telemetry):
+            with open(telemetry) as f:
+                result['telemetry'] = f.read()
+        shutil.rmtree(run_path, ignore_errors=True)
+
+        try:
+            job_broker.put_result(result)
+        except (EOFError, ConnectionError):
+            break
+
+
+def broker_authkey(generate=False):
+    # Shared secret of the coordinator and its workers, from EP_BROKER_KEY.
+    # The broker exchanges pickles, so there is no default key: without EP_BROKER_KEY the coordinator makes
+    # a random one to hand to its workers (generate=True) and workers refuse to start.
+    key = os.environ.get('EP_BROKER_KEY')
+    if key:
+        return key.encode()
+    if not generate:
+        raise RuntimeError('EP_BROKER_KEY is not set, use the key printed by the coordinator.')
+    key = secrets.token_hex(16)
+    print('EP_BROKER_KEY is not set, the workers must use: EP_BROKER_KEY={}'.format(key))
+
+    return key.encode()
+
+
+def broker_host():
+    # Address of this host on its network, so the broker does not listen on every interface
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            # No packet is sent, this only picks the interface of the default route
+            s.connect(('10.255.255.255', 1))
+            return s.getsockname()[0]
+        except OSError:
+            return '127.0.0.1'
+
+
+async def run_pipeline(ep_path, output_path, idf_path, weather_path, jobs, pending, workers, master_file, lca,
+                       ledger=None, cache=None, limits=None, telemetry=None, scratch_path=None, keep=None, group=None):
+    # Overlap the simulations with the results stage: the batch runs in a thread while every finished run is
+    # assessed in a worker process and its rows are appended to the master table right away,
+    # and saved to the results store of the group when one is given.
+    # The master table is rewritten from scratch, so the stored buildings of the group are cleared first.
+    # Runs done by earlier batches (jobs that are not pending) are assessed first.
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Queue()
+    pending_keys = {(job['idf_name'], job['weather_file']) for job in pending}
+    for job in jobs:
+        if (job['idf_name'], job['weather_file']) not in pending_keys:
+            finished.put_nowait(job)
+
+    def on_result(job, output_files):
+        loop.call_soon_threadsafe(finished.put_nowait, job)
+
+    simulations = loop.run_in_executor(None, functools.partial(
+        run_batch, ep_path, output_path, idf_path, weather_path, pending, workers, ledger, cache, limits, telemetry,
+        scratch_path, keep, on_result))
+    simulations.add_done_callback(lambda future: finished.put_nowait(None))
+
+    # Compile the LCA databases once here rather than in every worker process
+    ep_3results.load_databases()
+    if group is not None:
+        ep_3results.prune_results(group)
+    # Worker processes are spawned, forking next to the running simulation threads is not safe
+    with ProcessPoolExecutor(lca['processes'], mp_context=multiprocessing.get_context('spawn'),
+                             initializer=ep_3results.init_worker,
+                             initargs=(lca['impact_categories'], lca['study_period'], lca['electric_cost'])) as pool, \
+            open(master_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        columns = ep_3results.MASTER_ATTRIBUTES + lca['impact_categories'] + ['Cost']
+        writer.writerow(columns)
+
+        async def assess(job):
+            file_name = result_file(output_path, job)
+            try:
+                rows = await loop.run_in_executor(pool, ep_3results.results_worker, output_path, file_name)
+            except Exception as error:
+                print('Results of {} with {} could not be assessed: {}'.format(job['idf_name'], job['weather_file'],
+                                                                               error))
+                return False
+            # Only the event loop writes, so rows of different buildings never interleave
+            writer.writerows(rows)
+            f.flush()
+            if group is not None:
+                ep_3results.store_results(rows, columns, group)
+            return True
+
+        assessments = []
+        while True:
+            job = await finished.get()
+            if job is None:
+                break
+            assessments.append(asyncio.ensure_future(assess(job)))
+        assessed = sum(await asyncio.gather(*assessments))
+
+    print('{} of {} buildings assessed into "{}".'.format(assessed, len(assessments), master_file))
+
+    return await simulations
+
+
+def result_file(output_path, job):
+    # Output of a run holding its tabular xml, the run archive when outputs are compacted
+    prefix = output_prefix(job['idf_name'], job['weather_file'])
+    if os.path.isfile('{}{}.zip'.format(output_path, prefix)):
+        return '{}.zip'.format(prefix)
+
+    return '{}Table.xml'.format(prefix)
+
+
+def screen_jobs(ep_path, screen_path, idf_group, idf_path, weather_path, jobs, workers, cache, screening, limits=None,
+                telemetry=None, scratch_path=None, quantities=None):
+    # Run every job over the screening weeks only, in its own output directory and ledger, then keep the candidates.
+    # Design-day-only runs (-D) are not used, EnergyPlus leaves the annual tables empty without a weather file run.
+    os.makedirs(screen_path, exist_ok=True)
+    weeks = screening.get('weeks', SCREENING_WEEKS)
+    screen = [dict(job, idf_text=None, render=functools.partial(screening_text, job, idf_path, weeks),
+                   inputs='{}|{}'.format(job['inputs'], weeks)) for job in jobs]
+    ledger = open_ledger('{}{}_jobs.sqlite'.format(screen_path, idf_group))
+    pending = ledger_pending(ledger, screen)
+    print('\nScreening with {} simulations of {} weeks ({} to run).'.format(len(screen), len(weeks), len(pending)))
+    run_batch(ep_path, screen_path, idf_path, weather_path, pending, workers, ledger, cache, limits, telemetry,
+              scratch_path)
+    ledger.close()
+
+    # Annual site energy intensity of every screened (design, location), extrapolated from the screening weeks
+    scores = {}
+    for job in jobs:
+        file_name = result_file(screen_path, job)
+        if os.path.isfile('{}{}'.format(screen_path, file_name)):
+            scores[(job['idf_name'], job['weather_file'])] = screening_intensity(screen_path, file_name) * 365 / (
+                7 * len(weeks))
+
+    embodied = {}
+    if screening['mode'] == 'pareto':
+        embodied = embodied_scores(quantities or {}, sorted({design for design, location in scores}),
+                                   screening['objectives'])
+
+    candidates = select_candidates(scores, screening, embodied)
+    print('{} of {} designs selected for annual simulations: {}'.format(
+        len(candidates), len({job['idf_name'] for job in jobs}), sorted(candidates)))
+
+    return [job for job in jobs if job['idf_name'] in candidates]
+
+
+def screening_idf(idf_text, weeks):
+    # Model text with its RunPeriods replaced by one-week RunPeriods starting on the given (month, day)
+    lines = []
+    skipping = False
+    for line in idf_text.splitlines():
+        code = line.split('!', 1)[0]
+        if not skipping and re.match(r'\s*RunPeriod\s*,', code, re.IGNORECASE):
+            skipping = True
+        if skipping:
+            skipping = ';' not in code
+            continue
+        lines.append(line)
+
+    for number, (month, day) in enumerate(weeks, start=1):
+        begin = datetime.date(2017, month, day)
+        end = begin + datetime.timedelta(days=6)
+        lines += ['',
+                  'RunPeriod,',
+                  '    Screening Week {},{}!- Name'.format(number, ' ' * 8),
+                  '    {},{}!- Begin Month'.format(begin.month, ' ' * 22),
+                  '    {},{}!- Begin Day of Month'.format(begin.day, ' ' * 22),
+                  '    {},{}!- End Month'.format(end.month, ' ' * 22),
+                  '    {},{}!- End Day of Month'.format(end.day, ' ' * 22),
+                  '    UseWeatherFile,          !- Day of Week for Start Day',
+                  '    Yes,                     !- Use Weather File Holidays and Special Days',
+                  '    Yes,                     !- Use Weather File Daylight Saving Period',
+                  '    No,                      !- Apply Weekend Holiday Rule',
+                  '    Yes,                     !- Use Weather File Rain Indicators',
+                  '    Yes;                     !- Use Weather File Snow Indicators']
+
+    return '\n'.join(lines) + '\n'
+
+
+def screening_text(job, idf_path, weeks):
+    return screening_idf(job_text(job, idf_path), weeks)
+
+
+def screening_intensity(path, file_name):
+    # Total site energy per floor area of the simulated period from a tabular xml output or run archive
+    results = ep_3results.read_tabular(ep_3results.open_result(path.rstrip('/'), file_name))
+
+    return results.total_energy / results.floor_area
+
+
+def embodied_scores(quantities, designs, objectives):
+    # Embodied impacts and material cost (objectives: impact categories and 'Cost') of every design, from the
+    # bills of quantities of ep_1setup priced with the LCA databases of ep_3results
+    lca = ep_3results.load_databases()['lca']
+    priced = []
+    for design in designs:
+        if design not in quantities:
+            print('No embodied score for {}: it has no bill of quantities.'.format(design))
+            continue
+        try:
+            ep_3results.check_constructions(lca, quantities[design])
+        except KeyError as error:
+            print('No embodied score for {}: {} is missing.'.format(design, error))
+            continue
+        priced.append(design)
+
+    impact_categories = [objective for objective in objectives if objective != 'Cost']
+    scores = {}
+    for design, rows in zip(priced, ep_3results.material_rows(lca, priced, [quantities[d] for d in priced],
+                                                              impact_categories)):
+        totals = dict(zip(impact_categories + ['Cost'], [sum(column) for column in zip(*[row[10:] for row in rows])]))
+        scores[design] = [totals.get(objective, 0.0) for objective in objectives]
+
+    return scores
+
+
+def select_candidates(scores, screening, embodied=None):
+    # 'top': the k designs with the lowest screening intensity in every location
+    # 'pareto': designs that no other design beats at once in the energy intensity of every location and in the
+    # embodied objectives. Designs without an embodied score can only be selected on their energy intensity.
+    locations = sorted({location for design, location in scores})
+    designs = sorted({design for design, location in scores})
+    if screening['mode'] == 'top':
+        candidates = set()
+        for location in locations:
+            ranked = sorted((scores[(design, location)], design) for design in designs if (design, location) in scores)
+            candidates |= {design for score, design in ranked[:screening['k']]}
+    elif screening['mode'] == 'pareto':
+        objectives = len(next(iter(embodied.values()))) if embodied else 0
+        vectors = {design: [scores.get((design, location), float('inf')) for location in locations] +
+                   embodied.get(design, [float('inf')] * objectives)
+                   for design in designs}
+        candidates = set()
+        for design, vector in vectors.items():
+            dominated = any(all(o <= v for o, v in zip(other, vector)) and other != vector
+                            for other in vectors.values())
+            if not dominated:
+                candidates.add(design)
+    else:
+        raise ValueError('Unknown screening mode: {}'.format(screening['mode']))
+
+    return candidates
+
+
+def open_ledger(ledger_file, fresh=False):
+    # Persistent record of every (design, weather) job: pending, running, done or failed
+    ledger = sqlite3.connect(ledger_file, check_same_thread=False)
+    if fresh:
+        ledger.execute('DROP TABLE IF EXISTS jobs')
+    ledger.execute('CREATE TABLE IF NOT EXISTS jobs (idf_name TEXT, weather_file TEXT, inputs TEXT, status TEXT, '
+                   'outputs TEXT, attempts INTEGER DEFAULT 0, updated REAL, PRIMARY KEY (idf_name, weather_file))')
+    # Jobs left running by a batch that crashed or was interrupted start over
+    ledger.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+    ledger.commit()
+
+    return ledger
+
+
+def ledger_pending(ledger, jobs):
+    # Register the jobs and return the ones that still have to run.
+    # A done job is run again when its inputs changed or one of its outputs disappeared.
+    pending = []
+    with LEDGER_LOCK:
+        for job in jobs:
+            row = ledger.execute('SELECT status, inputs, outputs FROM jobs WHERE idf_name = ? AND weather_file = ?',
+                                 (job['idf_name'], job['weather_file'])).fetchone()
+            if (row is not None and row[0] == 'done' and row[1] == job['inputs']
+                    and all(os.path.isfile(f) for f in json.loads(row[2]))):
+                continue
+            ledger.execute('INSERT OR REPLACE INTO jobs (idf_name, weather_file, inputs, status, outputs, attempts, '
+                           'updated) VALUES (?, ?, ?, ?, ?, COALESCE((SELECT attempts FROM jobs WHERE idf_name = ? '
+                           'AND weather_file = ?), 0), ?)',
+                           (job['idf_name'], job['weather_file'], job['inputs'], 'pending', '[]',
+                            job['idf_name'], job['weather_file'], time.time()))
+            pending.append(job)
+        ledger.commit()
+
+    return pending
+
+
+def ledger_update(ledger, job, status, output_files=None):
+    with LEDGER_LOCK:
+        if status == 'running':
+            ledger.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ? '
+                           'WHERE idf_name = ? AND weather_file = ?',
+                           (status, time.time(), job['idf_name'], job['weather_file']))
+        else:
+            ledger.execute('UPDATE jobs SET status = ?, outputs = ?, updated = ? WHERE idf_name = ? AND weather_file = ?',
+                           (status, json.dumps(output_files or []), time.time(), job['idf_name'], job['weather_file']))
+        ledger.commit()
+
 
 def select_run():
     i = 0
     while i < 1:
-        selection = input('\nRun single file or a batch of files? (Options: Single | Batch)\n>> ')
+        selection = input('\nRun single file, a batch of files or the design space directly? '
+                          '(Options: Single | Batch | Direct)\n>> ')
 
         if selection.lower() in 'single':
             print('\nSINGLE file run selected.')
@@ -151,10 +1246,22 @@ def select_run():
         elif selection.lower() in 'batch':
             print('\nBATCH file run selected.')
             i = 1
+        elif selection.lower() in 'direct':
+            print('\nDIRECT design space run selected.')
+            i = 1
         else:
             print('\nInvalid entry. Try again.')
 
     return selection
 
 
-if __name__ == "__main__": main()
\ No newline at end of file
+if __name__ == "__main__":
+    if len(argv) > 2 and argv[1] == 'telemetry':
+        summarize_telemetry(argv[2])
+    elif len(argv) > 2 and argv[1] == 'worker':
+        # python ep_2run.py worker <coordinator host>:<port> [workers]
+        coordinator_host, coordinator_port = argv[2].rsplit(':', 1)
+        run_worker((coordinator_host, int(coordinator_port)), ep_1setup.energyplus_paths()[0],
+                   int(argv[3]) if len(argv) > 3 else os.cpu_count())
+    else:
+        main()
\ No newline at end of file
@@ -9,10 +9,44 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import xml.etree.ElementTree as ET
 import json
+import io
+import zipfile
 import requests
+import re
+from sys import argv
+import csv
+import hashlib
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 plt.style.use('ggplot')
 
+# Impact assessment method and the columns of the master table read by ep_4analysis
+TRACI_2_1 = ['LCI_ODP', 'LCI_GWP', 'LCI_SFP', 'LCI_AP', 'LCI_EP', 'LCI_C', 'LCI_NC', 'LCI_RE', 'LCI_ETX', 'LCI_FFD']
+MASTER_ATTRIBUTES = ['Number', 'Building', 'Category', 'Scale', 'Source', 'System', 'Construction', 'Layer',
+                     'Element', 'Ingredient', 'Stage']
+# Databases and LCA settings held by each results worker process
+WORKER = {}
+# Results of a tabular xml used by the assessment, surfaces are (construction, area) pairs
+TabularResults = namedtuple('TabularResults', ['total_energy', 'floor_area', 'enduse_names', 'enduse_electricity',
+                                               'opaque_surfaces', 'window_surfaces'])
+# Tables read from the xml, by report
+TABULAR_TABLES = {'AnnualBuildingUtilityPerformanceSummary': ('SiteAndSourceEnergy', 'BuildingArea', 'EndUses'),
+                  'EnvelopeSummary': ('OpaqueExterior', 'ExteriorFenestration')}
+# Electricity prices in cents per kWh by state and year, kept offline in a local table (State,Year,Price)
+# and refreshed from the EIA API with: python ep_3results.py prices [state ...] [--force]
+PRICE_TABLE = './Data/electricity_prices.csv'
+PRICE_TTL = 180 * 24 * 3600     # Seconds after which the price table is out of date and is fetched again
+EIA_API_KEY = os.environ.get('EIA_API_KEY', 'c4aba82a2396b58e6fc44fd09d109160')
+# Price tables loaded by this process, by path
+PRICES = {}
+# Columnar results store: one directory per group and building holding one .npy file per master table column
+RESULTS_STORE = './Results/store'
+# Source spreadsheets of the compiled databases in ./Data
+DATABASE_SOURCES = ['data_constructions', 'data_materials', 'data_windows', 'data_impacts', 'data_costs',
+                    'variable_metadata']
+
 '''
 MAIN BODY
 Pseudo-code:
@@ -37,78 +71,436 @@ def main():
 
     # ACCESSING E+ OUTPUT FILE DATA
     # Define path and extension of E+ output files to load
-    xml_path = './Models/ss1_output'
+    idf_group = 'ss1'
+    xml_path = './Models/{}_output'.format(idf_group)
     xml_extension = '.xml'
-    atb0 = 'ss1_01'
+    archive_extension = '.zip'  # Runs compacted by ep_2run keep their tabular xml in <design>_<location>.zip
     study_period = 30   # LCA study period in years
-
-    # List all xml results file names in the specified directory
-    xml_list = [f for f in os.listdir(xml_path) if f.endswith(xml_extension)]
+    electricity_state = 'PA'    # State of the grid electricity price
+    electricity_year = None     # Options: None (latest year in the price table), a year such as 2017
+    tariff = 'table'    # Options: 'table' (local price table, offline), 'eia' (live EIA request)
+    # Assess every output of the group into ./Results/<group>_summary__master.csv, or only the first one in detail
+    mode = 'batch'  # Options: 'batch', 'single'
+    processes = os.cpu_count()  # Worker processes of the batch mode
+
+    # List all xml results file names (or run archives) in the specified directory
+    xml_list = [f for f in os.listdir(xml_path) if f.endswith(xml_extension) or f.endswith(archive_extension)]
     xml_list = sorted(xml_list)
     xml_count = len(xml_list)
     print('List of xml files: {}'.format(xml_list))
     print('Number of xml files: {}'.format(xml_count))
 
-    # Analyze results from an xml output file
-    # Setup xml reader
-    tree = ET.parse('{}/{}'.format(xml_path, xml_list[0]))
-    root = tree.getroot()
+    # Impact assessment methods and categories
+    impact_categories = TRACI_2_1
+
+    # Electric cost for the selected year in cents per kWh
+    electric_cost = electricity_price(electricity_state, electricity_year, tariff)
+    print('Electric cost: {} cents per kWh'.format(electric_cost))
+
+    if mode == 'batch':
+        master_file = './Results/{}_summary__master.csv'.format(idf_group)
+        assess_batch(xml_path, xml_list, master_file, impact_categories, study_period, electric_cost, processes,
+                     idf_group)
+    else:
+        # Analyze results from an xml output file
+        # Read the tabular results in a single pass
+        results = read_tabular(open_result(xml_path, xml_list[0]))
+        atb0 = building_id(xml_list[0])
+
+        # Preload all necessary databases
+        databases = load_databases()
+        df_metadata = databases['metadata']                    # Variable metadata
+
+        # Define energy disaggregation end use names
+        enduse_names_array = ['Heating', 'Cooling', 'InteriorLighting', 'ExteriorLighting', 'InteriorEquipment',
+                              'ExteriorEquipment', 'Fans', 'Pumps', 'HeatRejection', 'Humidification', 'HeatRecovery',
+                              'WaterSystems', 'Refrigeration', 'Generators', 'TotalEndUses']
+
+        itemized_results = assess_building(results, atb0, databases, impact_categories, study_period, electric_cost,
+                                           export_path='./Results/', verbose=True)
+
+        # Create a data frame from itemized results
+        attributes = ['Building', 'Category', 'Scale', 'Source', 'System', 'Construction', 'Layer', 'Element',
+                      'Ingredient', 'Stage']
+        print(itemized_results)
+        # Summarize all surface impact results
+        df_master = pd.DataFrame(itemized_results)              # Create a data frame from itemized results
+        df_master.columns = attributes + impact_categories + ['Cost']      # Define headers
+        print(df_master)                                        # Print itemized results
+        df_master.to_csv('./Results/{}_EnvelopeMaster.csv'.format(atb0))  # Export itemized results to csv
+
+        print(df_master.groupby('Category').sum().reset_index())
+
+    # Print total program runtime
+    print('\n Total run time:')
+    stop = timeit.default_timer()
+    print('{0:.4g} seconds'.format(stop - start))
+    print('\n---END---')
+
+
+'''
+FUNCTIONS
+'''
+
 
-    # Preload all necessary databases
-    df_con = pd.read_csv('./Data/data_constructions.csv')   # Load constructions spreadsheet
+def load_databases(data_path='./Data', cache_path='./Data/compiled'):
+    # Compiled construction, material, window, impact and cost databases and the variable metadata.
+    # They are compiled from the spreadsheets into ./Data/compiled/lca_<hash> only when one of them changes,
+    # the arrays are memory mapped so loading them in every worker process costs next to nothing.
+    hashes = source_hashes(data_path, cache_path)
+    key = hashlib.sha256(json.dumps(hashes, sort_keys=True).encode()).hexdigest()[:16]
+    compiled_path = '{}/lca_{}'.format(cache_path, key)
+
+    if not os.path.isfile('{}/index.json'.format(compiled_path)):
+        compile_databases(data_path, cache_path, compiled_path, hashes)
+
+    return read_databases(compiled_path)
+
+
+def source_hashes(data_path, cache_path):
+    # Hash of every spreadsheet. Hashes are kept in ./Data/compiled/sources.json with the size and modification
+    # time of the file, a spreadsheet is only read and hashed again when those change.
+    stamps_file = '{}/sources.json'.format(cache_path)
+    stamps = {}
+    if os.path.isfile(stamps_file):
+        with open(stamps_file) as f:
+            stamps = json.load(f)
+
+    hashes = {}
+    changed = False
+    for source in DATABASE_SOURCES:
+        source_file = '{}/{}.csv'.format(data_path, source)
+        stat = os.stat(source_file)
+        stamp = [os.path.abspath(source_file), stat.st_size, stat.st_mtime_ns]
+        if stamps.get(source, {}).get('stamp') == stamp:
+            hashes[source] = stamps[source]['hash']
+            continue
+        with open(source_file, 'rb') as f:
+            hashes[source] = hashlib.sha256(f.read()).hexdigest()
+        stamps[source] = {'stamp': stamp, 'hash': hashes[source]}
+        changed = True
+
+    if changed:
+        # Write to a temporary name first so concurrent workers never read a partial file
+        os.makedirs(cache_path, exist_ok=True)
+        temp_file = '{}.{}'.format(stamps_file, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(stamps, f)
+        os.replace(temp_file, stamps_file)
+
+    return hashes
+
+
+def compile_databases(data_path, cache_path, compiled_path, hashes):
+    # Read the spreadsheets, resolve the layers and save the arrays with a json index of their names
+    df_con = pd.read_csv('{}/data_constructions.csv'.format(data_path))   # Load constructions spreadsheet
     df_con['Name'] = df_con['Name'].str.upper()             # Make all construction names uppercase for matching
     df_con.set_index('Name', inplace=True)                  # Set index
-    df_mat = pd.read_csv('./Data/data_materials.csv')       # Load materials spreadsheet
+    df_mat = pd.read_csv('{}/data_materials.csv'.format(data_path))       # Load materials spreadsheet
     df_mat.set_index('Name', inplace=True)                  # Set index
-    df_win = pd.read_csv('./Data/data_windows.csv')         # Load materials spreadsheet
+    df_win = pd.read_csv('{}/data_windows.csv'.format(data_path))         # Load materials spreadsheet
     df_win.set_index('Name', inplace=True)                  # Set index
-    df_if = pd.read_csv('./Data/data_impacts.csv')          # Load impact data spreadsheet
+    df_if = pd.read_csv('{}/data_impacts.csv'.format(data_path))          # Load impact data spreadsheet
     df_if.set_index('LCI_name', inplace=True)               # Set index
-    df_cost = pd.read_csv('./Data/data_costs.csv')          # Load cost data spreadsheet
+    df_cost = pd.read_csv('{}/data_costs.csv'.format(data_path))          # Load cost data spreadsheet
     df_cost.set_index('Cost_name', inplace=True)            # Set index
-    df_metadata = pd.read_csv('./Data/variable_metadata.csv')  # Load variable metadata
+    df_metadata = pd.read_csv('{}/variable_metadata.csv'.format(data_path))   # Load variable metadata
     df_metadata.set_index('Meta_name', inplace=True)        # Set index
-    itemized_results = []                                   # This is where all results will be collected
+    lca = compile_lca(df_con, df_mat, df_win, df_if, df_cost)  # Layers resolved into factor matrices
+
+    # Write to a temporary directory first so concurrent workers never read a partial database
+    os.makedirs(cache_path, exist_ok=True)
+    temp_path = '{}.{}'.format(compiled_path, os.getpid())
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    for name in ('impacts', 'layer_impacts', 'quantities', 'costs'):
+        np.save('{}/{}.npy'.format(temp_path, name), lca[name])
+    df_metadata.to_pickle('{}/metadata.pickle'.format(temp_path))
+    index = {'sources': hashes,
+             'categories': lca['categories'],
+             'impact_names': list(lca['impact_rows']),
+             'layers': lca['layers'],
+             'construction_layers': {c: [int(rows[0]), int(rows[-1]) + 1] if len(rows) else [0, 0]
+                                     for c, rows in lca['construction_layers'].items()},
+             'errors': {c: str(error.args[0]) if error.args else '' for c, error in lca['errors'].items()}}
+    with open('{}/index.json'.format(temp_path), 'w') as f:
+        json.dump(index, f)
+    try:
+        os.rename(temp_path, compiled_path)
+    except OSError:
+        # Another process compiled the same spreadsheets first
+        shutil.rmtree(temp_path, ignore_errors=True)
+        return
+
+    # Databases compiled from earlier versions of the spreadsheets are not needed any more
+    for name in os.listdir(cache_path):
+        if name.startswith('lca_') and '{}/{}'.format(cache_path, name) != compiled_path and '.' not in name:
+            shutil.rmtree('{}/{}'.format(cache_path, name), ignore_errors=True)
+    print('LCA databases compiled into "{}".'.format(compiled_path))
+
+
+def read_databases(compiled_path):
+    # Compiled databases with the arrays memory mapped
+    with open('{}/index.json'.format(compiled_path)) as f:
+        index = json.load(f)
+    lca = {name: np.load('{}/{}.npy'.format(compiled_path, name), mmap_mode='r')
+           for name in ('impacts', 'layer_impacts', 'quantities', 'costs')}
+    lca['categories'] = index['categories']
+    lca['impact_rows'] = {name: i for i, name in enumerate(index['impact_names'])}
+    lca['layers'] = [tuple(layer) for layer in index['layers']]
+    lca['construction_layers'] = {c: np.arange(start, stop) for c, (start, stop) in
+                                  index['construction_layers'].items()}
+    lca['errors'] = {c: KeyError(message) for c, message in index['errors'].items()}
+
+    return {'lca': lca, 'metadata': pd.read_pickle('{}/metadata.pickle'.format(compiled_path))}
+
+
+def compile_lca(df_con, df_mat, df_win, df_if, df_cost):
+    # Resolve every construction into its layers once: the quantity of each layer per m2 of construction in the
+    # unit of its impact factors and of its cost, the impact factor row of the layers and their cost per m2.
+    # Constructions with a missing material, impact or cost entry keep the error to raise when they are used.
+    categories = [column for column in df_if.columns if column.startswith('LCI_') and column != 'LCI_unit']
+    impact_rows = {name: i for i, name in enumerate(df_if.index)}
+    layers = []             # (construction, layer) of every layer row
+    quantities, layer_impacts, cost_quantities, cost_factors = [], [], [], []
+    construction_layers = {}
+    errors = {}
+    for construction in df_con.index:
+        df_data = df_win if 'WINDOW' in construction else df_mat
+        rows = []
+        try:
+            for layer in df_con.loc[construction].dropna().tolist():
+                lci_name = df_data['LCI_name'].loc[layer]           # Find layer material in impact database
+                cost_name = df_data['Cost_name'].loc[layer]
+                thickness = df_data['Thickness'].loc[layer]
+                density = df_data['Density'].loc[layer]
+                rows.append((layer,
+                             unit_quantity(df_if['LCI_unit'].loc[lci_name], thickness, density, construction, layer),
+                             impact_rows[lci_name],
+                             unit_quantity(df_cost['Cost_unit'].loc[cost_name], thickness, density, construction,
+                                           layer),
+                             df_cost['Cost_material'].loc[cost_name]))
+        except KeyError as error:
+            errors[construction] = error
+            continue
+        construction_layers[construction] = np.arange(len(layers), len(layers) + len(rows))
+        for layer, quantity, impact_row, cost_quantity, cost_factor in rows:
+            layers.append((construction, layer))
+            quantities.append(quantity)
+            layer_impacts.append(impact_row)
+            cost_quantities.append(cost_quantity)
+            cost_factors.append(cost_factor)
+
+    return {'categories': categories,
+            'impact_rows': impact_rows,
+            'layers': layers,
+            'construction_layers': construction_layers,
+            'errors': errors,
+            'impacts': df_if[categories].to_numpy(dtype=float),
+            'layer_impacts': np.array(layer_impacts, dtype=int),
+            'quantities': np.array(quantities, dtype=float),
+            'costs': np.array(cost_quantities, dtype=float) * np.array(cost_factors, dtype=float)}
+
+
+def impact_factor(lca, lci_name, impact_category):
+    # Impact factor of an lci name for one impact category
+    return lca['impacts'][lca['impact_rows'][lci_name], lca['categories'].index(impact_category)]
+
+
+def unit_quantity(unit, thickness, density, construction=None, material=None):
+    # Quantity of a layer per m2 of construction in the given unit
+    if unit in ('kg', 'lbs'):
+        quantity = thickness * density
+        if unit in 'lbs':
+            quantity = quantity * 2.2046
+    elif unit in ('m3', 'ft3', 'yd3'):
+        quantity = thickness
+        if unit in 'ft3':
+            quantity = quantity * 35.3107
+        elif unit in 'yd3':
+            quantity = quantity * 1.3079
+    elif unit in ('m2', 'ft2', 'yd2'):
+        quantity = 1.0
+        if unit in 'ft2':
+            quantity = quantity * 10.7639
+        elif unit in 'yd2':
+            quantity = quantity * 1.1960
+    else:
+        quantity = 0.0
+        print('Unknown units! Total for {}/{} set to 0!'.format(construction, material))
 
-    # Impact assessment methods and categories
-    traci_2_1 = ['LCI_ODP', 'LCI_GWP', 'LCI_SFP', 'LCI_AP', 'LCI_EP', 'LCI_C', 'LCI_NC', 'LCI_RE', 'LCI_ETX', 'LCI_FFD']
-    impact_categories = traci_2_1
+    return quantity
 
-    # Define energy disaggregation end use names
-    enduse_names_array = ['Heating', 'Cooling', 'InteriorLighting', 'ExteriorLighting', 'InteriorEquipment',
-                          'ExteriorEquipment', 'Fans', 'Pumps', 'HeatRejection', 'Humidification', 'HeatRecovery',
-                          'WaterSystems', 'Refrigeration', 'Generators', 'TotalEndUses']
+
+def construction_areas(surfaces):
+    # Total area of each construction of a building, by upper case construction name
+    areas = {}
+    for construction, area in surfaces:
+        areas[construction.upper()] = areas.get(construction.upper(), 0.0) + area
+
+    return areas
+
+
+def check_constructions(lca, areas):
+    # Raise the error of the first construction of a building that is missing from the databases
+    for construction in areas:
+        if construction not in lca['construction_layers']:
+            raise lca['errors'].get(construction, KeyError(construction))
+
+
+def material_rows(lca, buildings, areas, impact_categories):
+    # Itemized material rows of many buildings computed in one tensor op. areas holds the construction areas
+    # of each building, the rows of a building follow its constructions in alphabetical order.
+    for building_areas in areas:
+        check_constructions(lca, building_areas)
+
+    # Layer rows used by any of the buildings and the buildings x layers area matrix
+    constructions = sorted(set().union(*areas))
+    layer_rows = np.concatenate([lca['construction_layers'][c] for c in constructions] + [np.array([], dtype=int)])
+    area_matrix = np.zeros((len(buildings), len(layer_rows)))
+    offsets, offset = {}, 0
+    for construction in constructions:
+        offsets[construction] = slice(offset, offset + len(lca['construction_layers'][construction]))
+        offset += len(lca['construction_layers'][construction])
+    for b, building_areas in enumerate(areas):
+        for construction, area in building_areas.items():
+            area_matrix[b, offsets[construction]] = area
+
+    # Bill of quantities x impact factor matrix, and x cost vector
+    columns = [lca['categories'].index(category) for category in impact_categories]
+    quantities = area_matrix * lca['quantities'][layer_rows]
+    factors = lca['impacts'][lca['layer_impacts'][layer_rows]][:, columns]
+    impacts = quantities[:, :, np.newaxis] * factors[np.newaxis, :, :]
+    costs = area_matrix * lca['costs'][layer_rows]
+
+    itemized_results = []
+    for b, building in enumerate(buildings):
+        rows = []
+        for construction in sorted(areas[b]):
+            window = 'WINDOW' in construction
+            for i in range(offsets[construction].start, offsets[construction].stop):
+                layer = lca['layers'][layer_rows[i]][1]
+                attribute_values = [building, 'Materials', 'n/a', 'n/a', assign_system(construction), construction,
+                                    layer, 'Glazing' if window else 'n/a', 'Glass' if window else 'n/a',
+                                    'Manufacturing']
+                rows.append(attribute_values + impacts[b, i].tolist() + [float(costs[b, i])])
+        itemized_results.append(rows)
+
+    return itemized_results
+
+
+def electricity_price(state='PA', year=None, tariff='table'):
+    # Electric cost in cents per kWh from a tariff provider, for the latest year unless a year is given
+    return TARIFF_PROVIDERS[tariff](state, year)
+
+
+def table_price(state, year=None, price_table=PRICE_TABLE):
+    # Electric cost from the local price table, never touches the network
+    prices = load_prices(price_table)
+    years = [price_year for price_state, price_year in prices if price_state == state]
+    if not years:
+        raise KeyError('No electricity price for {} in "{}", run: python ep_3results.py prices {}'.format(
+            state, price_table, state))
+
+    return prices[(state, year or max(years))]
+
+
+def eia_price(state, year=None):
+    # Electric cost requested from the EIA API
+    prices = fetch_prices(state)
+
+    return prices[year or max(prices)]
+
+
+def load_prices(price_table=PRICE_TABLE):
+    # Price table by (state, year), read once per process and again only when the file changes
+    if not os.path.isfile(price_table):
+        raise FileNotFoundError('No electricity price table "{}", run: python ep_3results.py prices'.format(
+            price_table))
+    stat = os.stat(price_table)
+    if price_table not in PRICES or PRICES[price_table][0] != stat.st_mtime_ns:
+        prices = {}
+        with open(price_table, newline='') as f:
+            for row in csv.DictReader(f):
+                prices[(row['State'], int(row['Year']))] = float(row['Price'])
+        PRICES[price_table] = (stat.st_mtime_ns, prices)
+        if time.time() - stat.st_mtime > PRICE_TTL:
+            print('Electricity price table "{}" is out of date, refresh it with: python ep_3results.py prices'.format(
+                price_table))
+
+    return PRICES[price_table][1]
+
+
+def fetch_prices(state):
+    # Annual average retail price of electricity of a state (all sectors) from the EIA API, by year
+    response = requests.get('http://api.eia.gov/series/?api_key={}&series_id=ELEC.PRICE.{}-ALL.A&out=xml'.format(
+        EIA_API_KEY, state), timeout=60)
+    rows = ET.fromstring(response.content).findall('./series/row/data/row')
+
+    return {int(row.findtext('date')[:4]): float(row.findtext('value')) for row in rows}
+
+
+def refresh_prices(states, price_table=PRICE_TABLE, force=False):
+    # Fetch the prices of the states into the price table, unless the table is younger than PRICE_TTL
+    # and already holds them
+    prices = dict(load_prices(price_table)) if os.path.isfile(price_table) else {}
+    fresh = os.path.isfile(price_table) and time.time() - os.path.getmtime(price_table) < PRICE_TTL
+    missing = [state for state in states if state not in {price_state for price_state, price_year in prices}]
+    if fresh and not missing and not force:
+        print('Electricity price table "{}" is up to date.'.format(price_table))
+        return price_table
+
+    for state in states:
+        for year, price in fetch_prices(state).items():
+            prices[(state, year)] = price
+
+    # Write to a temporary name first so running assessments never read a partial table
+    os.makedirs(os.path.dirname(price_table) or '.', exist_ok=True)
+    temp_file = '{}.{}'.format(price_table, os.getpid())
+    with open(temp_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['State', 'Year', 'Price'])
+        for (state, year), price in sorted(prices.items()):
+            writer.writerow([state, year, price])
+    os.replace(temp_file, price_table)
+    print('Electricity prices of {} saved to "{}".'.format(', '.join(states), price_table))
+
+    return price_table
+
+
+# Tariff providers, each returns the electric cost in cents per kWh of a state and year
+TARIFF_PROVIDERS = {'table': table_price, 'eia': eia_price}
+
+
+def assess_building(results, atb0, databases, impact_categories, study_period, electric_cost, export_path=None,
+                    verbose=False, materials=True):
+    # Itemized energy, water and material impacts and costs of one building from its tabular results.
+    # With materials=False the material rows are left out, for assessing them for many buildings at once.
+    lca = databases['lca']
+    log = print if verbose else lambda *args: None
+    itemized_results = []                                   # This is where all results will be collected
 
     # BUILDING ENERGY USE
     # Extract total site energy in kWh
-    total_energy = root.findall('./AnnualBuildingUtilityPerformanceSummary/SiteAndSourceEnergy/TotalEnergy')[0].text
-    total_energy = float(total_energy) * study_period
-    print('Total annual energy use: {:.2f} kWh'.format(total_energy))
+    total_energy = results.total_energy * study_period
+    log('Total annual energy use: {:.2f} kWh'.format(total_energy))
 
     # Identify energy source and lci name
     energy_source = 'Electricity, low voltage {RFC}| electricity production, photovoltaic, 3kWp slanted-roof ' \
                     'installation, multi-Si, panel, mounted | Alloc Def, S'
-    print('Energy source:\n{}'.format(energy_source))
+    log('Energy source:\n{}'.format(energy_source))
 
     # Calculate impacts due to energy
     energy_impacts = []
     for impact_category in impact_categories:
-        lci_if = df_if[impact_category].loc[energy_source]          # Select impact factor for name and category
+        lci_if = impact_factor(lca, energy_source, impact_category)     # Select impact factor for name and category
         impact_total = lci_if * total_energy
         energy_impacts.append(impact_total)
 
-    # Accessing EIA grid electricity cost data via API
-    # Make a get request to get the latest data
-    response = requests.get('http://api.eia.gov/series/?api_key=c4aba82a2396b58e6fc44fd09d109160'
-                            '&series_id=ELEC.PRICE.PA-ALL.A&out=xml')
-    # Electric cost for last year in cents per kWh
-    electric_cost = ET.fromstring(response.content).findall('./series/row/data/row/value')[0].text
     total_energy_cost = float(electric_cost)/100.00 * total_energy
-    print('Total annual energy cost: ${:.2f}'.format(total_energy_cost))
+    log('Total annual energy cost: ${:.2f}'.format(total_energy_cost))
 
-    # Create a data frame from itemized results
-    attributes = ['Building', 'Category', 'Scale', 'Source', 'System', 'Construction', 'Layer', 'Element',
-                  'Ingredient', 'Stage']
+    # Attributes of the itemized results
     # atb0 = building
     # atb1 = category # Options: Energy, Water, Materials
     # atb2 = scale # Options: Grid, On-site, District, Purchased, n/a
@@ -132,31 +524,13 @@ def main():
     attribute_values = [atb0, atb1, atb2, atb3, atb4, atb5, atb6, atb7, atb8, atb9]
     itemized_results.append(attribute_values + energy_impacts + [total_energy_cost])
 
-    # Extract building floor area
-    floor_area = root.findall('./AnnualBuildingUtilityPerformanceSummary/BuildingArea/TotalBuildingArea')[0].text
-    # Convert the text from 'str' to 'float'
-    floor_area = float(floor_area)
-    print('Gross floor area: {} m2'.format(floor_area))
+    # Building floor area
+    floor_area = results.floor_area
+    log('Gross floor area: {} m2'.format(floor_area))
 
     # EXTRACTING SURFACE & MATERIAL DATA
-    # Setup empty list for storing all surface data
-    surfaces = []
-
-    # Extract all opaque surface data from the xml
-    opaque_areas = root.findall('./EnvelopeSummary/OpaqueExterior')
-    for surface in opaque_areas:
-        construction = surface.find('Construction').text
-        area = float(surface.find('NetArea').text)
-        surfaces.append([construction, area])
-
-    # Extract all window surface data from the xml
-    window_areas = root.findall('./EnvelopeSummary/ExteriorFenestration')
-    # Drop the last three elements in the window area list (total and average rows in the csv)
-    window_areas = window_areas[:-3]
-    for window in window_areas:
-        construction = window.find('Construction').text
-        area = float(window.find('AreaOfMultipliedOpenings').text)
-        surfaces.append([construction, area])
+    # All opaque and window surface data from the xml
+    surfaces = results.opaque_surfaces + results.window_surfaces
 
     # Create a data frame containing all of the extracted surface data
     # Create a new data frame consisting of data from the surface list
@@ -167,29 +541,31 @@ def main():
     # them in uppercase, it is done here just in case something changes in future E+ releases
     df_sd['Construction'] = df_sd['Construction'].str.upper()
     # Print and save the envelope construction summary
-    df_sd.to_csv('./Results/ss1_01_EnvelopeSummaryDetailed.csv')
-    print('Envelope construction details exported.')
+    if export_path is not None:
+        df_sd.to_csv('{}{}_EnvelopeSummaryDetailed.csv'.format(export_path, atb0))
+        log('Envelope construction details exported.')
 
     # Sum areas for each construction and save as a new data frame
     df_ss = pd.DataFrame((df_sd.groupby('Construction').sum().reset_index()))
     df_ss.set_index('Construction', inplace=True)         # Make construction names the new index
-    df_ss.to_csv('./Results/ss1_01_EnvelopeSummary.csv')
     constructions = df_ss.index.tolist()                  # List of constructions in the model
-    print('Envelope construction summary exported.')
-    print('Unique envelope constructions: {}'.format(len(constructions)))
+    if export_path is not None:
+        df_ss.to_csv('{}{}_EnvelopeSummary.csv'.format(export_path, atb0))
+        log('Envelope construction summary exported.')
+    log('Unique envelope constructions: {}'.format(len(constructions)))
 
     # WATER AND SEWAGE TREATMENT
     # Average annual precipitation in meters/year including rainfall and snowfall
     precipitation = 1.089 * df_ss['Area'].loc['ROOF A']         # Average annual precipitation in m
     water_demand = 15 * 0.0407458 * floor_area                  # Annual water use in 15 gal/sf converted to m3
-    print('Total annual water demand: {:.2f} m3'.format(water_demand))
-    print('Total annual wastewater discharge: {:.2f} m3'.format(water_demand))
-    print('Total annual precipitation runoff: {:.2f} m3'.format(precipitation))
+    log('Total annual water demand: {:.2f} m3'.format(water_demand))
+    log('Total annual wastewater discharge: {:.2f} m3'.format(water_demand))
+    log('Total annual precipitation runoff: {:.2f} m3'.format(precipitation))
 
     water_source = 'Treatment plant, potable water'
     water_impacts = []
     for impact_category in impact_categories:
-        lci_if = df_if[impact_category].loc[water_source]          # Select impact factor for name and category
+        lci_if = impact_factor(lca, water_source, impact_category)      # Select impact factor for name and category
         impact_total = lci_if * water_demand * study_period
         water_impacts.append(impact_total)
 
@@ -208,7 +584,7 @@ def main():
     sewage_treatment = 'Treatment plant, wastewater'
     sewage_impacts = []
     for impact_category in impact_categories:
-        lci_if = df_if[impact_category].loc[sewage_treatment]          # Select impact factor for name and category
+        lci_if = impact_factor(lca, sewage_treatment, impact_category)  # Select impact factor for name and category
         impact_total = lci_if * water_demand * study_period
         sewage_impacts.append(impact_total)
 
@@ -227,7 +603,7 @@ def main():
     storm_treatment = 'Treatment plant, wastewater'
     storm_impacts = []
     for impact_category in impact_categories:
-        lci_if = df_if[impact_category].loc[storm_treatment]  # Select impact factor for name and category
+        lci_if = impact_factor(lca, storm_treatment, impact_category)   # Select impact factor for name and category
         impact_total = lci_if * precipitation * study_period
         storm_impacts.append(impact_total)
 
@@ -246,181 +622,255 @@ def main():
     # MATERIALS
     # Calculate environmental impact for the whole building
 
-    print('Constructions present in this model:')
+    log('Constructions present in this model:')
     for construction in constructions:
-        print(construction)
-
-    for construction in constructions:
-        if 'WINDOW' not in construction:
-            c_area = df_ss['Area'].loc[construction]            # Create area variable for use within this loop
-            layers = df_con.loc[construction].dropna().tolist()  # Select construction, drop empty layers, save to list
-
-            # for all layers in the selected construction, execute the following loop
-            for layer in layers:
-                lci_name = df_mat['LCI_name'].loc[layer]        # Find layer material in impact database
-                lci_unit = df_if['LCI_unit'].loc[lci_name]      # Check unit for which impact factors are provided
-
-                layer_impacts = []
-                for impact_category in impact_categories:
-                    lci_if = df_if[impact_category].loc[lci_name]   # Select impact factor for name and category
-                    impact_total = calc_dv(construction, layer, lci_unit, lci_if, df_mat, df_ss)
-                    layer_impacts.append(impact_total)
-
-                cost_name = df_mat['Cost_name'].loc[layer]
-                cost_unit = df_cost['Cost_unit'].loc[cost_name]
-                cost_factor = df_cost['Cost_material'].loc[cost_name]
-                layer_cost = calc_dv(construction, layer, cost_unit, cost_factor, df_mat, df_ss)
-
-                atb1 = 'Materials'
-                atb2 = 'n/a'
-                atb3 = 'n/a'
-                atb4 = assign_system(construction)
-                atb5 = construction
-                atb6 = layer
-                atb7 = 'n/a'
-                atb8 = 'n/a'
-                atb9 = 'Manufacturing'
-                attribute_values = [atb0, atb1, atb2, atb3, atb4, atb5, atb6, atb7, atb8, atb9]
-                itemized_results.append(attribute_values + layer_impacts + [layer_cost])
+        log(construction)
+
+    if materials:
+        itemized_results += material_rows(lca, [atb0], [construction_areas(surfaces)],
+                                          impact_categories)[0]
+
+    return itemized_results
+
+
+def assess_batch(xml_path, xml_list, master_file, impact_categories, study_period, electric_cost, processes=None,
+                 group=None):
+    # Read every run output in worker processes, assess the materials of all buildings in one batch and write
+    # all their rows into one master table, and into the results store of the group when one is given.
+    # The store then holds the same buildings as the master table, partitions of other buildings are removed.
+    # Rows are written in file order, a run that cannot be assessed is reported and left out.
+    databases = load_databases()
+    buildings, numbers, itemized_results, areas, failed = [], [], [], [], []
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(tabular_worker, xml_path, file_name) for file_name in xml_list]
+        for file_name, future in zip(xml_list, futures):
+            try:
+                results = future.result()
+                building = building_id(file_name)
+                number = building_number(building)
+                building_areas = construction_areas(results.opaque_surfaces + results.window_surfaces)
+                check_constructions(databases['lca'], building_areas)
+                rows = assess_building(results, building, databases, impact_categories, study_period, electric_cost,
+                                       materials=False)
+            except Exception as error:
+                print('Results of {} could not be assessed: {}'.format(file_name, error))
+                failed.append(file_name)
+                continue
+            buildings.append(building)
+            numbers.append(number)
+            itemized_results.append(rows)
+            areas.append(building_areas)
+
+    materials = material_rows(databases['lca'], buildings, areas, impact_categories)
+    columns = MASTER_ATTRIBUTES + impact_categories + ['Cost']
+    master_rows = []
+    with open(master_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for number, rows, building_materials in zip(numbers, itemized_results, materials):
+            rows = [[number] + row for row in rows + building_materials]
+            writer.writerows(rows)
+            master_rows += rows
+    if group is not None:
+        store_results(master_rows, columns, group)
+        prune_results(group, buildings)
+
+    print('{} of {} buildings assessed into "{}".'.format(len(xml_list) - len(failed), len(xml_list), master_file))
+
+    return failed
+
+
+def store_results(rows, columns, group, store_path=RESULTS_STORE, append=False):
+    # Save master table rows into the results store, partitioned by building.
+    # The rows of a building replace its partition, or are added to the end of it with append=True.
+    group_path = '{}/{}'.format(store_path, group)
+    os.makedirs(group_path, exist_ok=True)
+    with open('{}/columns.json'.format(group_path), 'w') as f:
+        json.dump(columns, f)
+
+    building_column = columns.index('Building')
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(row[building_column], []).append(row)
+
+    for building, building_rows in partitions.items():
+        partition_path = '{}/{}'.format(group_path, building)
+        values = list(zip(*building_rows))
+        arrays = {column: column_array(column, values[i]) for i, column in enumerate(columns)}
+        if append and os.path.isdir(partition_path):
+            arrays = {column: np.concatenate([np.load('{}/{}.npy'.format(partition_path, column)), array])
+                      for column, array in arrays.items()}
+
+        # Write to a temporary directory first so readers never see a partial partition.
+        # Temporary directories start with '.tmp-', building names can contain dots (e.g. from the weather file).
+        temp_path = '{}/.tmp-{}.{}'.format(group_path, building, os.getpid())
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        for column, array in arrays.items():
+            np.save('{}/{}.npy'.format(temp_path, column), array)
+        if os.path.isdir(partition_path):
+            old_path = '{}/.tmp-old-{}.{}'.format(group_path, building, os.getpid())
+            os.rename(partition_path, old_path)
+            os.rename(temp_path, partition_path)
+            shutil.rmtree(old_path, ignore_errors=True)
         else:
-            c_area = df_ss['Area'].loc[construction]              # Create area variable for use within this loop
-            layers = df_con.loc[construction].dropna().tolist()   # Select construction, drop empty layers, save to list
-
-            # for all layers in the selected construction, execute the following loop
-            for layer in layers:
-                lci_name = df_win['LCI_name'].loc[layer]    # Find window in impact database
-                lci_unit = df_if['LCI_unit'].loc[lci_name]  # Check unit for which impact factors are provided
-
-                layer_impacts = []
-                for impact_category in impact_categories:
-                    lci_if = df_if[impact_category].loc[lci_name]   # Select impact factor for name and category
-                    impact_total = calc_dv(construction, layer, lci_unit, lci_if, df_win, df_ss)
-                    layer_impacts.append(impact_total)
-
-                cost_name = df_win['Cost_name'].loc[layer]
-                cost_unit = df_cost['Cost_unit'].loc[cost_name]
-                cost_factor = df_cost['Cost_material'].loc[cost_name]
-                layer_cost = calc_dv(construction, layer, cost_unit, cost_factor, df_win, df_ss)
-
-                atb1 = 'Materials'
-                atb2 = 'n/a'
-                atb3 = 'n/a'
-                atb4 = assign_system(construction)
-                atb5 = construction
-                atb6 = layer
-                atb7 = 'Glazing'
-                atb8 = 'Glass'
-                atb9 = 'Manufacturing'
-                attribute_values = [atb0, atb1, atb2, atb3, atb4, atb5, atb6, atb7, atb8, atb9]
-                itemized_results.append(attribute_values + layer_impacts + [layer_cost])
-
-    print(itemized_results)
-    # Summarize all surface impact results
-    df_master = pd.DataFrame(itemized_results)              # Create a data frame from itemized results
-    df_master.columns = attributes + impact_categories + ['Cost']      # Define headers
-    print(df_master)                                        # Print itemized results
-    df_master.to_csv('./Results/ss1_01_EnvelopeMaster.csv')  # Export itemized results to csv
-
-    print(df_master.groupby('Category').sum().reset_index())
+            os.rename(temp_path, partition_path)
 
-    # Print total program runtime
-    print('\n Total run time:')
-    stop = timeit.default_timer()
-    print('{0:.4g} seconds'.format(stop - start))
-    print('\n---END---')
+    return group_path
 
 
-'''
-FUNCTIONS
-'''
+def prune_results(group, buildings=(), store_path=RESULTS_STORE):
+    # Remove the partitions of every building of a group that is not in buildings, so that the store holds the
+    # same buildings as the master table written with it
+    if not os.path.isdir('{}/{}'.format(store_path, group)):
+        return
+    for building in stored_buildings(group, store_path):
+        if building not in buildings:
+            shutil.rmtree('{}/{}/{}'.format(store_path, group, building), ignore_errors=True)
 
 
-def extract_floor_area(path, file_name):
-    # Open xml file with path and file name
-    tree = ET.parse('{}/{}'.format(path, file_name))
-    root = tree.getroot()
+def column_array(column, values):
+    # Array of a master table column: design numbers, text attributes or impact and cost values
+    if column == 'Number':
+        return np.array(values, dtype=np.int64)
+    elif column in MASTER_ATTRIBUTES:
+        return np.array([str(value) for value in values])
 
-    # Find the specific results we are looking for
-    floor_area = root.findall('./AnnualBuildingUtilityPerformanceSummary/BuildingArea/TotalBuildingArea')[0].text
-    # Convert the text from 'str' to 'float'
-    floor_area = float(floor_area)
+    return np.array(values, dtype=float)
 
-    return floor_area
 
+def stored_buildings(group, store_path=RESULTS_STORE):
+    # Buildings of a group in the results store
+    group_path = '{}/{}'.format(store_path, group)
+
+    return sorted(name for name in os.listdir(group_path)
+                  if not name.startswith('.tmp-') and os.path.isdir('{}/{}'.format(group_path, name)))
+
+
+def load_results(group, columns=None, buildings=None, store_path=RESULTS_STORE):
+    # Master table of a group from the results store, reading only the files of the selected columns and buildings
+    group_path = '{}/{}'.format(store_path, group)
+    if columns is None:
+        with open('{}/columns.json'.format(group_path)) as f:
+            columns = json.load(f)
+    if buildings is None:
+        buildings = stored_buildings(group, store_path)
 
-def extract_surface_areas(path, file_name):
-    # Open xml file with path and file name
-    tree = ET.parse('{}/{}'.format(path, file_name))
-    root = tree.getroot()
+    data = {}
+    for column in columns:
+        arrays = [np.load('{}/{}/{}.npy'.format(group_path, building, column), mmap_mode='r')
+                  for building in buildings]
+        data[column] = np.concatenate(arrays) if arrays else np.array([])
 
-    # Find the specific results we are looking for
-    surface_area = root.findall('./EnvelopeSummary/OpaqueExterior')
+    return pd.DataFrame(data, columns=columns)
 
-    return surface_area
 
+def building_id(file_name):
+    # <design>_<location> of a run from the name of its output (<design>_<location>Table.xml or .zip)
+    for extension in ('Table.xml', '.zip', '.xml'):
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
 
-def extract_enduse_names(path, file_name):
-    # Open xml file with path and file name
-    tree = ET.parse('{}/{}'.format(path, file_name))
-    root = tree.getroot()
+    return file_name
 
-    # find the specific results we are looking for
-    enduse_names = root.findall('./AnnualBuildingUtilityPerformanceSummary/EndUses/name')
-    enduse_names_array = []
 
-    for enduse in enduse_names:
-        enduse_names_array.append(enduse.text)
+def building_number(building):
+    # Design number of a building id, 7 for ss1_07_PHL
+    match = re.search(r'_(\d+)', building)
+    if match is None:
+        raise ValueError('no design number in the building name {}'.format(building))
 
-    return enduse_names_array
+    return int(match.group(1))
 
 
-def extract_enduse_electricity(path, file_name):
-    # open xml file with path and file name
-    tree = ET.parse('{}/{}'.format(path, file_name))
-    root = tree.getroot()
+def init_worker(impact_categories, study_period, electric_cost):
+    WORKER['databases'] = load_databases()
+    WORKER['impact_categories'] = impact_categories
+    WORKER['study_period'] = study_period
+    WORKER['electric_cost'] = electric_cost
 
-    # show instance information
-    # building_name = root[0].text
-    # location_file = root[2].text
-    # location_city = location_file.split()
-    # print('\n {} in {}'.format(building_name,location_city[0]))
 
-    # find the specific results we are looking for
-    enduse_electricity = root.findall('./AnnualBuildingUtilityPerformanceSummary/EndUses/Electricity')
-    enduse_electricity_array = []
+def results_worker(path, file_name):
+    # Master table rows of one run: its design number followed by the itemized results
+    building = building_id(file_name)
+    results = read_tabular(open_result(path, file_name))
+    itemized_results = assess_building(results, building, WORKER['databases'], WORKER['impact_categories'],
+                                       WORKER['study_period'], WORKER['electric_cost'])
 
-    for enduse in enduse_electricity:
-        enduse_electricity_array.append(float(enduse.text))
+    return [[building_number(building)] + row for row in itemized_results]
 
-    return enduse_electricity_array
 
+def tabular_worker(path, file_name):
+    # Tabular results of one run
+    return read_tabular(open_result(path, file_name))
 
-def calc_dv(construction, material, unit, factor, df_data_materials, df_constructions_summary):
-    thickness = df_data_materials['Thickness'].loc[material]
-    density = df_data_materials['Density'].loc[material]
-    area = df_constructions_summary['Area'].loc[construction]
 
-    if unit in ('kg', 'lbs'):
-        if unit in 'lbs':
-            factor = factor * 2.2046
-        total = factor * thickness * density * area
-    elif unit in ('m3', 'ft3', 'yd3'):
-        if unit in 'ft3':
-            factor = factor * 35.3107
-        elif unit in 'yd3':
-            factor = factor * 1.3079
-        total = factor * thickness * area
-    elif unit in ('m2', 'ft2', 'yd2'):
-        if unit in 'ft2':
-            factor = factor * 10.7639
-        elif unit in 'yd2':
-            factor = factor * 1.1960
-        total = factor * area
-    else:
-        total = 0
-        print('Unknown units! Total for {}/{} set to 0!'.format(construction, material))
+def open_result(path, file_name):
+    # Tabular xml of a run, either the xml file itself or the one inside a run archive
+    if file_name.endswith('.zip'):
+        with zipfile.ZipFile('{}/{}'.format(path, file_name)) as archive:
+            xml_name = [name for name in archive.namelist() if name.endswith('Table.xml')][0]
+            return io.BytesIO(archive.read(xml_name))
+
+    return '{}/{}'.format(path, file_name)
 
-    return total
+
+def read_tabular(source):
+    # Results of a tabular xml (file name or file object) read in a single pass.
+    # Only the rows of TABULAR_TABLES are looked at and every row is dropped once read, so memory stays flat.
+    total_energy, floor_area = None, None
+    enduse_names, enduse_electricity, opaque_surfaces, window_surfaces = [], [], [], []
+    parents = []        # Elements enclosing the current one: report root, report, table row
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if len(parents) == 2:
+            # A table row of a report
+            tag = element.tag
+            if tag in TABULAR_TABLES.get(parents[1].tag, ()):
+                if tag == 'SiteAndSourceEnergy' and total_energy is None:
+                    total_energy = float(element.findtext('TotalEnergy'))
+                elif tag == 'BuildingArea' and floor_area is None:
+                    floor_area = float(element.findtext('TotalBuildingArea'))
+                elif tag == 'EndUses':
+                    enduse_names.append(element.findtext('name'))
+                    enduse_electricity.append(float(element.findtext('Electricity')))
+                elif tag == 'OpaqueExterior':
+                    opaque_surfaces.append([element.findtext('Construction'), float(element.findtext('NetArea'))])
+                elif tag == 'ExteriorFenestration':
+                    window_surfaces.append([element.findtext('Construction'),
+                                            element.findtext('AreaOfMultipliedOpenings')])
+            parents[1].remove(element)
+        elif len(parents) == 1:
+            parents[0].remove(element)
+
+    # Drop the last three window rows (total and average rows in the csv)
+    window_surfaces = [[construction, float(area)] for construction, area in window_surfaces[:-3]]
+
+    return TabularResults(total_energy, floor_area, enduse_names, enduse_electricity, opaque_surfaces,
+                          window_surfaces)
+
+
+def extract_floor_area(path, file_name):
+    # Building floor area of a run
+    return read_tabular(open_result(path, file_name)).floor_area
+
+
+def extract_surface_areas(path, file_name):
+    # (construction, net area) of the opaque exterior surfaces of a run
+    return read_tabular(open_result(path, file_name)).opaque_surfaces
+
+
+def extract_enduse_names(path, file_name):
+    # End use names of a run
+    return read_tabular(open_result(path, file_name)).enduse_names
+
+
+def extract_enduse_electricity(path, file_name):
+    # Electricity of each end use of a run
+    return read_tabular(open_result(path, file_name)).enduse_electricity
 
 
 def assign_system(item):
@@ -436,4 +886,9 @@ def assign_system(item):
         return 'n/a'
 
 
-if __name__ == "__main__": main()
\ No newline at end of file
+if __name__ == "__main__":
+    if len(argv) > 1 and argv[1] == 'prices':
+        # python ep_3results.py prices [state ...] [--force]
+        refresh_prices([state for state in argv[2:] if state != '--force'] or ['PA'], force='--force' in argv)
+    else:
+        main()
\ No newline at end of file
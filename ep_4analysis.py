@@ -7,6 +7,7 @@ import timeit
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import ep_3results
 
 plt.style.use('ggplot')
 
@@ -30,17 +31,24 @@ def main():
     # STUDY SETUP
     idf_group = 'ss2'
     study_period = 30   # LCA study period in years
+    buildings = None    # Options: None (all buildings of the group), list of buildings such as ['ss2_01_PHL']
 
     print('Program beginning.\n\nIdf group selected: {}\nStudy period: {}'.format(idf_group, study_period))
 
     # DATABASE AND CONSTANT VARIABLE SETUP
-    # Preload all necessary databases
-    df_master = pd.read_csv('./Results/{}_summary__master.csv'.format(idf_group))   # Load master spreadsheet
-
     # Impact assessment methods and categories
     traci_2_1 = ['LCI_ODP', 'LCI_GWP', 'LCI_SFP', 'LCI_AP', 'LCI_EP', 'LCI_C', 'LCI_NC', 'LCI_RE', 'LCI_ETX', 'LCI_FFD']
     impact_categories = traci_2_1
 
+    # Preload the master results, only the columns and buildings used here when the results store has them
+    if os.path.isdir('{}/{}'.format(ep_3results.RESULTS_STORE, idf_group)):
+        df_master = ep_3results.load_results(idf_group, ['Number', 'Building'] + impact_categories + ['Cost'],
+                                             buildings)
+    else:
+        df_master = pd.read_csv('./Results/{}_summary__master.csv'.format(idf_group))   # Load master spreadsheet
+        if buildings is not None:
+            df_master = df_master[df_master['Building'].isin(buildings)]
+
     attributes = ['Number', 'Building', 'Category', 'Scale', 'Source', 'System', 'Construction', 'Layer', 'Element',
                   'Ingredient', 'Stage']
 
@@ -0,0 +1,293 @@
+#!/usr/Anaconda3/bin/python3
+# ep_stub.py - stand-in for the EnergyPlus executable
+
+from sys import argv, exit
+import os
+import time
+import random
+import hashlib
+import tempfile
+import argparse
+import datetime
+import numpy as np
+import xml.etree.ElementTree as ET
+
+'''
+MAIN BODY
+Pseudo-code:
+- Read the command line the same way EnergyPlus does (-d -p -s -w -x -D, input file)
+- Wait for the configured latency, fail at the configured rate
+- Read the surfaces of the idf file and compute their areas
+- Write a synthetic tabular xml (SiteAndSourceEnergy, BuildingArea, EndUses, EnvelopeSummary) and the .err file
+
+Configuration through environment variables, so ep_2run can call it like EnergyPlus:
+- EP_STUB_LATENCY       seconds per annual run (default 0.5), shorter RunPeriods and design-day runs take less
+- EP_STUB_JITTER        relative spread of the latency (default 0.2)
+- EP_STUB_FAILURE_RATE  share of the runs that end with a fatal error (default 0)
+- EP_STUB_SEED          seed of the latency and failures, for reproducible load tests. It is mixed with the output
+                        prefix and the attempt number of the run, so every run and retry draws differently but the
+                        same way in every test. Attempts are counted in EP_STUB_STATE (default: a directory in the
+                        system temporary directory per seed), remove it to replay a test from the start.
+
+Use it with: ENERGYPLUS=./ep_stub.py python ep_2run.py
+'''
+
+VERSION = 'EnergyPlus, Version 8.8.0-stub'
+# End uses reported in the AnnualBuildingUtilityPerformanceSummary, as written by EnergyPlus
+END_USES = ['Heating', 'Cooling', 'Interior Lighting', 'Exterior Lighting', 'Interior Equipment',
+            'Exterior Equipment', 'Fans', 'Pumps', 'Heat Rejection', 'Humidification', 'Heat Recovery',
+            'Water Systems', 'Refrigeration', 'Generators', 'Total End Uses']
+FUELS = ['Electricity', 'NaturalGas', 'AdditionalFuel', 'DistrictCooling', 'DistrictHeating', 'Water']
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='energyplus', description='EnergyPlus stand-in for testing')
+    parser.add_argument('-a', '--annual', action='store_true')
+    parser.add_argument('-d', '--output-directory', default='.')
+    parser.add_argument('-D', '--design-day', action='store_true')
+    parser.add_argument('-i', '--idd')
+    parser.add_argument('-m', '--epmacro', action='store_true')
+    parser.add_argument('-p', '--output-prefix', default='eplus')
+    parser.add_argument('-r', '--readvars', action='store_true')
+    parser.add_argument('-s', '--output-suffix', default='L', choices=['L', 'C', 'D'])
+    parser.add_argument('-v', '--version', action='store_true')
+    parser.add_argument('-w', '--weather', default='in.epw')
+    parser.add_argument('-x', '--expandobjects', action='store_true')
+    parser.add_argument('input_file', nargs='?', default='in.idf')
+    args = parser.parse_args(argv[1:])
+
+    if args.version:
+        print(VERSION)
+        return 0
+
+    start = time.time()
+    seed = os.environ.get('EP_STUB_SEED')
+    if seed is None:
+        rng = random.Random()
+    else:
+        attempt = run_attempt(seed, args.output_prefix)
+        rng = random.Random('{}|{}|{}'.format(seed, args.output_prefix, attempt))
+    latency = float(os.environ.get('EP_STUB_LATENCY', 0.5))
+    jitter = float(os.environ.get('EP_STUB_JITTER', 0.2))
+    failure_rate = float(os.environ.get('EP_STUB_FAILURE_RATE', 0))
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    err_file = os.path.join(args.output_directory, '{}.err'.format(args.output_prefix))
+    table_suffix = {'L': 'tbl.xml', 'C': 'Table.xml', 'D': '-table.xml'}[args.output_suffix]
+    table_file = os.path.join(args.output_directory, '{}{}'.format(args.output_prefix, table_suffix))
+
+    for input_file in (args.input_file, args.weather):
+        if not os.path.isfile(input_file):
+            return write_err(err_file, start, 'Could not find input file: {}'.format(input_file))
+
+    with open(args.input_file, encoding='latin-1') as f:
+        idf_objects = read_idf(f.read())
+    # Like EnergyPlus, design-day-only runs leave the annual tables empty
+    days = 0 if args.design_day else run_days(idf_objects)
+
+    latency = latency * max(days / 365, 0.1)
+    time.sleep(max(0.0, rng.gauss(latency, latency * jitter)))
+    if rng.random() < failure_rate:
+        return write_err(err_file, start, 'Simulated failure (EP_STUB_FAILURE_RATE={})'.format(failure_rate))
+
+    building = simulate(idf_objects, args.weather, days)
+    write_table(table_file, building, args.weather)
+
+    return write_err(err_file, start)
+
+
+'''
+FUNCTIONS
+'''
+
+
+def run_attempt(seed, prefix):
+    # Attempt number of this run of the prefix, counted with one file per attempt that only one run can create
+    state_path = os.environ.get('EP_STUB_STATE') or os.path.join(tempfile.gettempdir(), 'ep_stub_{}'.format(seed))
+    os.makedirs(state_path, exist_ok=True)
+    attempt = 1
+    while True:
+        try:
+            os.close(os.open(os.path.join(state_path, '{}.{}'.format(prefix, attempt)), os.O_CREAT | os.O_EXCL))
+            return attempt
+        except FileExistsError:
+            attempt += 1
+
+
+def read_idf(idf_text):
+    # (object key, fields) of every object in the idf text
+    lines = [line.split('!', 1)[0] for line in idf_text.splitlines()]
+    objects = []
+    for block in ' '.join(lines).split(';'):
+        fields = [field.strip() for field in block.split(',')]
+        if fields[0]:
+            objects.append((fields[0].upper(), fields[1:]))
+
+    return objects
+
+
+def surface_area(coordinates):
+    # Area of a planar polygon from its flat x, y, z vertex list
+    vertices = np.array(coordinates, dtype=float).reshape(-1, 3)
+    cross = np.cross(vertices, np.roll(vertices, -1, axis=0)).sum(axis=0)
+
+    return float(np.linalg.norm(cross) / 2)
+
+
+def unit_factor(name, low, high):
+    # Stable pseudo-random value for a name, so every design keeps its own but repeatable performance
+    digest = hashlib.sha256(name.encode()).digest()
+
+    return low + (high - low) * int.from_bytes(digest[:4], 'big') / 2 ** 32
+
+
+def run_days(idf_objects):
+    # Days simulated with the weather file: the sum of the RunPeriods, a year without any
+    days = 0
+    for key, fields in idf_objects:
+        if key == 'RUNPERIOD':
+            # Blank dates default to the whole year
+            begin = datetime.date(2017, int(fields[1] or 1), int(fields[2] or 1))
+            end = datetime.date(2017, int(fields[3] or 12), int(fields[4] or 31))
+            days += (end - begin).days % 365 + 1
+
+    return days if any(key == 'RUNPERIOD' for key, fields in idf_objects) else 365
+
+
+def simulate(idf_objects, weather_file, days=365):
+    # Synthetic areas and energy use, derived from the surfaces and constructions of the model
+    surfaces = []
+    windows = []
+    for key, fields in idf_objects:
+        if key == 'BUILDINGSURFACE:DETAILED':
+            # Name, type, construction, zone, boundary condition, ..., number of vertices, vertices
+            surfaces.append({'name': fields[0].upper(), 'type': fields[1], 'construction': fields[2].upper(),
+                             'boundary': fields[4], 'area': surface_area([v for v in fields[10:] if v])})
+        elif key == 'FENESTRATIONSURFACE:DETAILED':
+            # Name, type, construction, base surface, ..., multiplier, number of vertices, vertices
+            multiplier = float(fields[8]) if fields[8] else 1.0
+            windows.append({'name': fields[0].upper(), 'type': fields[1], 'construction': fields[2].upper(),
+                            'surface': fields[3].upper(),
+                            'area': surface_area([v for v in fields[10:] if v]) * multiplier})
+
+    opening_area = {}
+    for window in windows:
+        opening_area[window['surface']] = opening_area.get(window['surface'], 0) + window['area']
+    for surface in surfaces:
+        surface['net_area'] = surface['area'] - opening_area.get(surface['name'], 0)
+
+    exterior = [s for s in surfaces if s['boundary'] not in ('Surface', 'Zone', 'Adiabatic')]
+    floor_area = sum(s['area'] for s in surfaces if s['type'] == 'Floor') or 100.0
+    ua = (sum(s['net_area'] * unit_factor(s['construction'], 0.2, 2.0) for s in exterior) +
+          sum(w['area'] * unit_factor(w['construction'], 1.0, 5.0) for w in windows))
+    climate = unit_factor(os.path.basename(weather_file), 0.6, 1.6)
+    window_area = sum(w['area'] for w in windows)
+
+    # Annual energy by end use in kWh
+    electricity = {'Heating': ua * climate * 60,
+                   'Cooling': (window_area * 120 + floor_area * 10) * (2.2 - climate),
+                   'Interior Lighting': floor_area * 35,
+                   'Interior Equipment': floor_area * 45}
+    electricity['Fans'] = 0.15 * (electricity['Heating'] + electricity['Cooling'])
+    electricity['Pumps'] = 0.03 * electricity['Heating']
+    # Energy of the simulated days only
+    electricity = {end_use: value * days / 365 for end_use, value in electricity.items()}
+    electricity['Total End Uses'] = sum(electricity.values())
+
+    building = {'floor_area': floor_area, 'electricity': electricity,
+                'exterior': exterior, 'windows': windows, 'name': 'BUILDING'}
+    for key, fields in idf_objects:
+        if key == 'BUILDING' and fields:
+            building['name'] = fields[0].upper()
+
+    return building
+
+
+def write_table(table_file, building, weather_file):
+    # Tabular xml with the layout of the EnergyPlus XML output style
+    root = ET.Element('EnergyPlusTabularReports')
+    ET.SubElement(root, 'BuildingName').text = building['name']
+    ET.SubElement(root, 'EnvironmentName').text = os.path.splitext(os.path.basename(weather_file))[0]
+    ET.SubElement(root, 'WeatherFileLocationTitle').text = os.path.basename(weather_file)
+    ET.SubElement(root, 'ProgramVersion').text = VERSION
+    ET.SubElement(root, 'SimulationTimestamp').text = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    summary = ET.SubElement(root, 'AnnualBuildingUtilityPerformanceSummary')
+    total = building['electricity']['Total End Uses']
+    area = building['floor_area']
+    for name, energy in (('Total Site Energy', total), ('Net Site Energy', total),
+                         ('Total Source Energy', total * 3.167), ('Net Source Energy', total * 3.167)):
+        row = ET.SubElement(summary, 'SiteAndSourceEnergy')
+        ET.SubElement(row, 'name').text = name
+        add_value(row, 'TotalEnergy', energy, 'kWh')
+        add_value(row, 'EnergyPerTotalBuildingArea', energy / area, 'kWh/m2')
+        add_value(row, 'EnergyPerConditionedBuildingArea', energy / area, 'kWh/m2')
+    for name, value in (('Total Building Area', area), ('Net Conditioned Building Area', area),
+                        ('Unconditioned Building Area', 0.0)):
+        row = ET.SubElement(summary, 'BuildingArea')
+        ET.SubElement(row, 'name').text = name
+        add_value(row, 'TotalBuildingArea' if name == 'Total Building Area' else 'Area', value, 'm2')
+    for end_use in END_USES:
+        row = ET.SubElement(summary, 'EndUses')
+        ET.SubElement(row, 'name').text = end_use
+        for fuel in FUELS:
+            value = building['electricity'].get(end_use, 0.0) if fuel == 'Electricity' else 0.0
+            add_value(row, fuel, value, 'm3' if fuel == 'Water' else 'kWh')
+
+    envelope = ET.SubElement(root, 'EnvelopeSummary')
+    for surface in building['exterior']:
+        row = ET.SubElement(envelope, 'OpaqueExterior')
+        ET.SubElement(row, 'name').text = surface['name']
+        ET.SubElement(row, 'Construction').text = surface['construction']
+        add_value(row, 'UFactorWithFilm', unit_factor(surface['construction'], 0.2, 2.0), 'W/m2-K')
+        add_value(row, 'GrossArea', surface['area'], 'm2')
+        add_value(row, 'NetArea', surface['net_area'], 'm2')
+    for window in building['windows']:
+        row = ET.SubElement(envelope, 'ExteriorFenestration')
+        ET.SubElement(row, 'name').text = window['name']
+        ET.SubElement(row, 'Construction').text = window['construction']
+        add_value(row, 'AreaOfMultipliedOpenings', window['area'], 'm2')
+        add_value(row, 'GlassUFactor', unit_factor(window['construction'], 1.0, 5.0), 'W/m2-K')
+        ET.SubElement(row, 'ParentSurface').text = window['surface']
+    # EnergyPlus closes the fenestration table with three total rows
+    window_area = sum(w['area'] for w in building['windows'])
+    north_area = 0.0
+    for name, value in (('Total or Average', window_area), ('North Total or Average', north_area),
+                        ('Non-North Total or Average', window_area - north_area)):
+        row = ET.SubElement(envelope, 'ExteriorFenestration')
+        ET.SubElement(row, 'name').text = name
+        ET.SubElement(row, 'Construction').text = ''
+        add_value(row, 'AreaOfMultipliedOpenings', value, 'm2')
+
+    ET.ElementTree(root).write(table_file, encoding='utf-8', xml_declaration=True)
+
+    return table_file
+
+
+def add_value(row, tag, value, units):
+    element = ET.SubElement(row, tag, units=units)
+    element.text = '{:.2f}'.format(value)
+
+    return element
+
+
+def write_err(err_file, start, fatal=None):
+    # Error file in the EnergyPlus format, ep_2run checks it for the completion line; returns the exit status
+    elapsed = time.time() - start
+    elapsed_text = '{:02d}hr {:02d}min {:5.2f}sec'.format(int(elapsed // 3600), int(elapsed % 3600 // 60),
+                                                          elapsed % 60)
+    with open(err_file, 'w') as f:
+        f.write('Program Version,{},YMD={}\n'.format(VERSION, time.strftime('%Y.%m.%d %H:%M')))
+        if fatal is None:
+            f.write('   ************* EnergyPlus Completed Successfully-- 0 Warning; 0 Severe Errors;'
+                    ' Elapsed Time={}\n'.format(elapsed_text))
+            return 0
+        f.write('   **  Fatal  ** {}\n'.format(fatal))
+        f.write('   ...Summary of Errors that led to program termination:\n')
+        f.write('   ************* EnergyPlus Terminated--Fatal Error Detected. 0 Warning; 1 Severe Errors;'
+                ' Elapsed Time={}\n'.format(elapsed_text))
+
+    return 1
+
+
+if __name__ == "__main__": exit(main())